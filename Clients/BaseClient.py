@@ -5,6 +5,8 @@ import logging
 import re
 import requests
 import os
+import threading
+import time
 from bs4 import BeautifulSoup as BS
 from copy import deepcopy
 from urllib.parse import parse_qs, urlparse
@@ -17,16 +19,26 @@ from Cryptodome.Cipher import AES
 import undetected_chromedriver as uc
 
 from Utils.commons import colprint, exec_os_cmd, pretty_time, retry, threaded, ExitException
+from Utils.HostHealthRegistry import HostHealthRegistry
+from Utils.HttpCache import HttpCache
+from Utils.ResolutionCache import ResolutionCache
+from Utils.M3u8Parser import M3u8Parser
+from Utils.Mp4Probe import Mp4Probe
 
 
 class BaseClient():
     '''
     Base Client Implementation for Site-specific clients
     '''
-    def __init__(self, request_timeout=30, session=None):
+    # min no. of segments sampled to estimate the download size of a HLS stream
+    SIZE_MIN_SAMPLES = 10
+
+    def __init__(self, request_timeout=30, session=None, cache_config=None, resolution_cache_ttl=0):
         # create a requests session and use across to re-use cookies
         self.req_session = session if session else requests.Session()
         self.request_timeout = request_timeout
+        # health of the hosts shared with downloaders, to skip the mirrors which are down
+        self.host_health = HostHealthRegistry.get_registry()
         try:
             self.hls_size_accuracy
         except AttributeError:
@@ -38,7 +50,17 @@ class BaseClient():
             "Connection": "keep-alive"
         }
         self.udb_episode_dict = {}   # dict containing all details of epsiodes
+        self.udb_dict_lock = threading.Lock()   # episodes can be updated from multiple threads
         self.cookies_file = os.path.join(os.path.dirname(__file__), '.udb_client_cookies.json')      # file containing re-usable cookies
+        # on-disk cache of metadata responses. disabled if not configured.
+        self.http_cache = None
+        if cache_config:
+            self.http_cache = HttpCache(os.path.join(os.path.dirname(__file__), '.udb_http_cache'), cache_config.get('ttls'),
+                                        cache_config.get('max_size_mb', 50), cache_config.get('ignore_params'))
+        # persisted links of resolved episodes, to skip resolving them again on a resume. disabled if ttl is 0.
+        self.resolution_cache = None
+        if resolution_cache_ttl:
+            self.resolution_cache = ResolutionCache(os.path.join(os.path.dirname(__file__), '.udb_resolution_cache.json'), resolution_cache_ttl)
         # list of invalid characters not allowed in windows file system
         self.invalid_chars = ['/', '\\', '"', ':', '?', '|', '<', '>', '*']
         self.bs = AES.block_size
@@ -48,11 +70,13 @@ class BaseClient():
         self._regex_extract = lambda rgx, txt, grp: re.search(rgx, txt).group(grp) if re.search(rgx, txt) else False
 
     def _update_udb_dict(self, parent_key, child_dict):
-        if parent_key in self.udb_episode_dict:
-            self.udb_episode_dict[parent_key].update(child_dict)
-        else:
-            self.udb_episode_dict[parent_key] = child_dict
-        self.logger.debug(f'Updated udb dict: {self.udb_episode_dict}')
+        with self.udb_dict_lock:
+            if parent_key in self.udb_episode_dict:
+                self.udb_episode_dict[parent_key].update(child_dict)
+            else:
+                self.udb_episode_dict[parent_key] = child_dict
+            # only the updated details are logged, as other episodes may be updated/used by other threads meanwhile
+            self.logger.debug(f'Updated udb dict of {parent_key}: {child_dict}')
 
     def _get_udb_dict(self):
         return self.udb_episode_dict
@@ -92,22 +116,49 @@ class BaseClient():
         if referer: header.update({'referer': referer})
         if return_type.lower() == 'json': header.update({'Accept': 'application/json'})
         if extra_headers: header.update(extra_headers)
+
+        # serve metadata from the cache if it is fresh. If stale, revalidate it with the server.
+        cache_ttl = cache_entry = None
+        if self.http_cache and request_type == 'get' and return_type.lower() in ('text', 'json'):
+            cache_ttl = self.http_cache.get_ttl(url)
+            cache_entry = self.http_cache.get(url) if cache_ttl else None
+            if cache_entry and self.http_cache.is_fresh(cache_entry):
+                self.logger.debug(f'Using cached response for {url = }')
+                return json.loads(cache_entry['body']) if return_type.lower() == 'json' else cache_entry['body']
+            if cache_entry:
+                header.update(self.http_cache.get_validators(cache_entry))
+
+        # fail fast instead of waiting for request timeout on a host which is down
+        self.host_health.check(url)
+        start_time = time.monotonic()
         # self.logger.debug(f'Cookies before request: {self.req_session.cookies.get_dict()}')
-        if request_type == 'get':
-            response = self.req_session.get(url, timeout=self.request_timeout, headers=header, cookies=cookies)
-        elif request_type == 'post':
-            response = self.req_session.post(url, timeout=self.request_timeout, headers=header, cookies=cookies, data=post_data, files=upload_data)
+        try:
+            if request_type == 'get':
+                response = self.req_session.get(url, timeout=self.request_timeout, headers=header, cookies=cookies)
+            elif request_type == 'post':
+                response = self.req_session.post(url, timeout=self.request_timeout, headers=header, cookies=cookies, data=post_data, files=upload_data)
+        except Exception:
+            self.host_health.record(url, False)
+            raise
+        self.host_health.record(url, response.status_code < 500, time.monotonic() - start_time)
         # self.logger.debug(f'Cookies after request: {self.req_session.cookies.get_dict()}')
         # print(response)
 
-        if response.status_code == 200:
+        if response.status_code == 304 and cache_entry:     # cached response is not modified
+            self.http_cache.refresh(url, cache_entry, cache_ttl)
+            return json.loads(cache_entry['body']) if return_type.lower() == 'json' else cache_entry['body']
+
+        elif response.status_code == 200:
             if return_type.lower() == 'text':
+                if cache_ttl: self.http_cache.put(url, response.text, response.headers, cache_ttl)
                 return response.text
             elif return_type.lower() == 'bytes':
                 return response.content
             elif return_type.lower() == 'json':
                 try:
-                    return response.json()
+                    data = response.json()
+                    if cache_ttl: self.http_cache.put(url, response.text, response.headers, cache_ttl)
+                    return data
                 except json.JSONDecodeError as jde:
                     _conditional_logger(silent, f'Invalid JSON response received')
             elif return_type.lower() == 'raw':
@@ -126,6 +177,53 @@ class BaseClient():
         else:
             _conditional_logger(silent, f'Failed with code: {response.status_code}')
 
+    def _is_link_alive(self, url, referer=None):
+        '''
+        check if the link is still accessible, by requesting only its first byte
+        '''
+        header = deepcopy(self.header)
+        header.update({'Range': 'bytes=0-0'})
+        if referer: header.update({'referer': referer})
+        try:
+            with self.req_session.get(url, timeout=self.request_timeout, headers=header, stream=True) as response:
+                return response.status_code in (200, 206)
+        except Exception as e:
+            self.logger.debug(f'Failed to access {url = }. Error: {e}')
+            return False
+
+    def _get_cached_resolution(self, episode_id, probe_link_key='downloadLink', referer=None):
+        '''
+        return the cached resolved data of an episode. Expired entries are re-used only if their link is still accessible.
+        '''
+        if self.resolution_cache is None:
+            return None
+
+        client = self.__class__.__name__
+        data, is_fresh = self.resolution_cache.get(client, episode_id)
+        if data is None or is_fresh:
+            return data
+
+        # validate the expired entry using any one of its links
+        probe_link = next(( v[probe_link_key] for v in data['links'].values() if isinstance(v, dict) and v.get(probe_link_key) ), None)
+        if probe_link and self._is_link_alive(probe_link, referer):
+            self.logger.debug(f'Cached links of {episode_id = } are still valid')
+            self.resolution_cache.refresh(client, episode_id)
+            return data
+
+        self.logger.debug(f'Cached links of {episode_id = } are no longer valid')
+        self.resolution_cache.remove(client, episode_id)
+
+    def _cache_resolution(self, episode_id, data, urls):
+        '''
+        cache the resolved data of an episode. Expiry is inferred from the signed urls, if any.
+        '''
+        if self.resolution_cache is None:
+            return
+        try:
+            self.resolution_cache.put(self.__class__.__name__, episode_id, data, urls)
+        except Exception as e:
+            self.logger.warning(f'Failed to cache resolved links of {episode_id = }. Error: {e}')
+
     def _get_bsoup(self, search_url, referer=None, request_type='get', extra_headers=None, cookies={}, post_data=None, upload_data=None, silent=False):
         '''
         return html parsed soup
@@ -206,25 +304,18 @@ class BaseClient():
         parse master m3u8 data and return dict of resolutions and m3u8 links
         '''
         m3u8_links = {}
-        base_url = '/'.join(master_m3u8_link.split('/')[:-1])
         self.logger.debug(f'Extracting m3u8 data from master link: {master_m3u8_link}')
         master_m3u8_data = self._send_request(master_m3u8_link, referer=referer)
         # self.logger.debug(f'{master_m3u8_data = }')
+        playlist = M3u8Parser.parse(master_m3u8_data, master_m3u8_link)
+        # resolution streams, named using NAME attribute if available, else using height of the resolution
+        variants = [ variant for variant in playlist.variants if variant.name or variant.resolution ]
+        self.logger.debug(f'Resolutions data: {[ (v.name, v.resolution, v.uri) for v in variants ]}')
 
-        _regex_list = lambda data, rgx, grp: [ url.group(grp) for url in re.finditer(rgx, data) ]
-        _full_link = lambda link: link if link.startswith('http') else base_url + '/' + link
-        resolutions = _regex_list(master_m3u8_data, r'RESOLUTION=(\d+x\d+)', 1)
-        resolution_names = _regex_list(master_m3u8_data, 'NAME="(.*)"', 1)
-        if len(resolution_names) == 0:
-            resolution_names = [ res.lower().split('x')[-1] for res in resolutions ]
-        resolution_links = _regex_list(master_m3u8_data, '(.*)m3u8', 0)
-        self.logger.debug(f'Resolutions data: {resolutions = }, {resolution_names = }, {resolution_links = }')
-
-        if len(resolution_links) == 0:
+        if len(variants) == 0:
             # check for original keyword in the link, or if '#EXT-X-ENDLIST' in m3u8 data
             self.logger.debug('Child resolutions not found. Checking if master link is original link')
-            master_is_child = re.search('#EXT-X-ENDLIST', master_m3u8_data)
-            if 'original' in master_m3u8_link or master_is_child:
+            if 'original' in master_m3u8_link or playlist.is_endlist:
                 self.logger.debug('master m3u8 link itself is the download link')
                 # treat is as mp4 to fetch metadata using ffprobe
                 duration, size, resolution = self._get_video_metadata(master_m3u8_link, 'mp4', referer)
@@ -237,33 +328,48 @@ class BaseClient():
                 }
                 # get approx download size and add file size if available
                 file_size = self._get_download_size(master_m3u8_link, referer)
-                if file_size: m3u8_links['1080'].update({'filesize_mb': file_size})
+                if file_size: m3u8_links[_res_key].update(file_size)
 
             return m3u8_links
 
         # calculate duration from any resolution, as it is same for all resolutions
-        temp_link = _full_link(resolution_links[0]) if resolution_links else master_m3u8_link
-        duration = pretty_time(self._get_video_metadata(temp_link, 'hls', referer)[0])
-
-        for _res, _pixels, _link in zip(resolution_names, resolutions, resolution_links):
-            # prepend base url if it is relative url
-            m3u8_link = _full_link(_link)
-            m3u8_links[_res.replace('p','')] = {
-                'resolution_size': _pixels,
-                'downloadLink': m3u8_link,
+        duration = pretty_time(self._get_video_metadata(variants[0].uri, 'hls', referer)[0])
+
+        for variant in variants:
+            _res = (variant.name or variant.resolution.lower().split('x')[-1]).replace('p','')
+            m3u8_links[_res] = {
+                'resolution_size': variant.resolution,
+                'downloadLink': variant.uri,
                 'downloadType': 'hls',
                 'duration': duration
             }
             # get approx download size and add file size if available
-            file_size = self._get_download_size(m3u8_link, referer)
-            if file_size: m3u8_links[_res.replace('p','')].update({'filesize_mb': file_size})
+            file_size = self._get_download_size(variant.uri, referer)
+            if file_size: m3u8_links[_res].update(file_size)
 
         return m3u8_links
 
+    def _fetch_range(self, link, start, end, referer=None):
+        '''
+        fetch the byte range [start, end] of the link. Returns: (data, total size of the file)
+        '''
+        header = deepcopy(self.header)
+        header.update({'Range': f'bytes={start}-{end}'})
+        if referer: header.update({'referer': referer})
+        with self.req_session.get(link, timeout=self.request_timeout, headers=header, stream=True) as response:
+            if response.status_code == 206:
+                # Content-Range: bytes <start>-<end>/<total size>
+                return response.content, int(response.headers['content-range'].split('/')[-1])
+            elif response.status_code == 200 and start == 0:
+                # range is ignored by server. read only the required bytes and drop the connection.
+                data = response.raw.read(end + 1, decode_content=True)
+                return data, int(response.headers.get('content-length', 0))
+            raise Exception(f'Range request failed with code: {response.status_code}')
+
     # step-4.2.2.2 -- used in GogoAnime, MyAsianTV
     def _get_video_metadata(self, link, link_type='mp4', referer=None):
         '''
-        return duration & size of the video using ffprobe command
+        return duration & size of the video by reading the mp4 header using range requests, with fallback to ffprobe command
         Note: size is available only for mp4 links
         '''
         duration, size, resolution = 0, None, None
@@ -272,8 +378,18 @@ class BaseClient():
             if link_type == 'hls':
                 self.logger.debug('Fetching video duration by parsing video link')
                 data = self._send_request(link)
-                duration = sum([ float(match.group(1)) for match in re.finditer('#EXTINF:(.*),', data) ])
+                duration = M3u8Parser.parse(data, link).duration
             else:
+                try:
+                    self.logger.debug(f'Fetching video metadata by reading mp4 header of {link}')
+                    duration, size, resolution = Mp4Probe(lambda start, end: self._fetch_range(link, start, end, referer)).probe()
+                    if resolution is None: raise Exception('Video track not found')
+                    self.logger.debug(f'Size fetched is {size} bytes, Resoltion: {resolution}, Duration: {duration} seconds')
+                    return round(duration), size, resolution
+                except Exception as e:
+                    # not a mp4 file (or range requests not supported). Let ffprobe figure it out.
+                    self.logger.debug(f'Failed to read mp4 header with error: {e}. Falling back to ffprobe...')
+
                 # add -show_streams in ffprobe to get more information
                 ffprobe_cmd = f'ffprobe -loglevel quiet -print_format json -show_format -select_streams v:0 -show_entries stream=width,height'
                 if referer:
@@ -292,20 +408,65 @@ class BaseClient():
 
         return round(duration), size, resolution
 
-    @threaded()
-    def _fetch_content_length(self, url):
+    @threaded(max_parallel=8, thread_name_prefix='udb-probe-')
+    def _get_videos_metadata(self, link, link_type='mp4', referer=None):
+        '''
+        multi-threaded version of _get_video_metadata, to fetch metadata of multiple links in parallel
+        '''
+        return self._get_video_metadata(link, link_type, referer)
+
+    @threaded(max_parallel=8, thread_name_prefix='udb-size-')
+    def _fetch_content_length(self, url, referer=None):
+        '''
+        return the size of the resource without downloading it. Uses HEAD request, with fallback to a GET for the first byte.
+        '''
+        header = deepcopy(self.header)
+        if referer: header.update({'referer': referer})
         try:
-            content_len = float(requests.get(url).headers.get('content-length', 0))
+            response = self.req_session.head(url, timeout=self.request_timeout, headers=header, allow_redirects=True)
+            content_len = int(response.headers.get('content-length', 0)) if response.status_code == 200 else 0
+            if content_len > 0:
+                return content_len
+
+            # some servers do not support HEAD, or do not send content-length for it. So, request only the first byte.
+            header.update({'Range': 'bytes=0-0'})
+            with self.req_session.get(url, timeout=self.request_timeout, headers=header, stream=True) as response:
+                if response.status_code == 206:
+                    # Content-Range: bytes 0-0/<total size>
+                    content_len = int(response.headers.get('content-range', '').split('/')[-1])
+                elif response.status_code == 200:
+                    # range is ignored by server. content-length is the full size, and body is not read.
+                    content_len = int(response.headers.get('content-length', 0))
+
         except Exception as e:
             self.logger.warning(f'Failed to fetch video content length for {url = }. Error: {e}')
             content_len = 0
 
         return content_len
 
+    def _estimate_total_size(self, sizes, total_count):
+        '''
+        estimate the total size of all segments from the sizes of sampled segments.
+        Returns: (estimated size, margin of error at 95% confidence) in bytes
+        '''
+        sample_count = len(sizes)
+        mean = sum(sizes) / sample_count
+        if sample_count >= total_count:
+            return mean * total_count, 0
+        if sample_count == 1:
+            return mean * total_count, None
+
+        # standard error of the mean, corrected for sampling without replacement from a finite playlist
+        variance = sum((size - mean) ** 2 for size in sizes) / (sample_count - 1)
+        std_error = (variance / sample_count) ** 0.5 * ((total_count - sample_count) / (total_count - 1)) ** 0.5
+
+        return mean * total_count, 1.96 * std_error * total_count
+
     # step-4.2.2.1.1
     def _get_download_size(self, m3u8_link, referer=None):
         '''
-        return the download file size (in MB) of a HLS stream based on estimation quality.
+        return the download size (in MB) of a HLS stream, estimated from a sample of segments based on accuracy.
+        Returns: dict with file size & its margin of error (in MB), or None if disabled/failed
         '''
         try:
             if self.hls_size_accuracy == 0:     # this parameter should be defined in respective client initialization
@@ -313,27 +474,21 @@ class BaseClient():
             self.logger.debug(f'Calculating download size for {m3u8_link = }')
             m3u8_data = self._send_request(m3u8_link, referer=referer)
             # extract ts segment urls. same as in HLS downloader
-            base_url = '/'.join(m3u8_link.split('/')[:-1])
-            normalize_url = lambda url, base_url: (url if url.startswith('http') else f'{base_url}/{url}')
-            urls = [ normalize_url(url.group(0), base_url) for url in re.finditer("^(?!#).+$", m3u8_data, re.MULTILINE) ]
-
-            # Logic for 'approx' quality: find content size of a few segments and multiply the average with number of segments
-            tgt_len = len(urls) * self.hls_size_accuracy // 100
-            url_set = urls[:tgt_len]
-            # define correction factor to adjust the estimated size
-            cf = 0.85 if self.hls_size_accuracy < 95 else 0.9
-            self.logger.debug(f'Segments considered based on accuracy of {self.hls_size_accuracy}% is {tgt_len}/{len(urls)}. Correction factor: {cf}')
-            content_lens = self._fetch_content_length(url_set)
-
-            # calculate total file size in bytes
-            if self.hls_size_accuracy == 100:
-                dl_size = sum(content_lens) * cf   # cf is required as video compresses after converting to mp4
-            else:
-                avg_content_len = sum(content_lens) / len(content_lens)
-                dl_size = avg_content_len * len(urls) * cf
-
-            dl_size = round(dl_size / (1024**2))         # bytes to MB
-            self.logger.debug(f'Download size is {dl_size} MB')
+            urls = M3u8Parser.parse(m3u8_data, m3u8_link).get_segment_urls()
+
+            # sample segments evenly spread across the playlist, as the segment sizes vary with the scenes (intro, credits etc.)
+            tgt_len = min(len(urls), max(self.SIZE_MIN_SAMPLES, len(urls) * self.hls_size_accuracy // 100))
+            url_set = [ urls[i * len(urls) // tgt_len] for i in range(tgt_len) ]
+            self.logger.debug(f'Segments considered based on accuracy of {self.hls_size_accuracy}% is {tgt_len}/{len(urls)}')
+            content_lens = [ size for size in self._fetch_content_length(url_set, referer) if size > 0 ]
+            if not content_lens:
+                raise Exception('Content length not available for any of the segments')
+
+            # Note: this is the size of segments to be downloaded. Final mp4 is usually smaller, as the TS container overhead is removed.
+            dl_size, margin = self._estimate_total_size(content_lens, len(urls))
+            dl_size = { 'filesize_mb': round(dl_size / (1024**2)) }       # bytes to MB
+            if margin: dl_size['filesize_margin_mb'] = round(margin / (1024**2))
+            self.logger.debug(f'Download size is {dl_size} based on {len(content_lens)}/{len(urls)} segments')
 
         except Exception as e:
             self.logger.warning(f'Failed to fetch download size for {m3u8_link = }. Error: {e}')
@@ -447,11 +602,17 @@ class BaseClient():
         ordered_download_links.extend([ j for j in download_links if j not in ordered_download_links ])
         # remove blacklisted urls
         ordered_download_links = [ j for j in ordered_download_links if not any(i in j.get('file') for i in blacklist_urls) ]
+        # move the links of hosts which are down to the end, so that backup sources on healthy mirrors are tried first
+        ordered_download_links.sort(key=lambda j: not self.host_health.is_available(pad_https(j.get('file'))))
 
         self.logger.debug(f'{ordered_download_links = }')
         if len(ordered_download_links) == 0:
             return {'error': 'No download links found after filtering'}
 
+        # fetch metadata of all mp4 links in parallel, instead of one after the other
+        mp4_links = [ pad_https(j.get('file')) for j in ordered_download_links if j.get('type', '').strip().lower() == 'mp4' and self.host_health.is_available(pad_https(j.get('file'))) ]
+        mp4_metadata = dict(zip(mp4_links, self._get_videos_metadata(mp4_links, 'mp4', link))) if mp4_links else {}
+
         # extract resolution links from source links
         self.logger.debug('Extracting resolution download links...')
         counter = 0
@@ -485,10 +646,17 @@ class BaseClient():
 
             elif dtype == 'mp4':
                 # if link is mp4, it is a direct download link
+                if resolution_links and not self.host_health.is_available(dlink):
+                    self.logger.debug(f'Host of mp4 link [{dlink}] is down and links are available from other mirrors. Skipping...')
+                    continue
                 self.logger.debug(f'Found mp4 link. Adding the direct download link [{dlink}]')
-                duration, file_size, resolution = self._get_video_metadata(dlink, link_type='mp4', referer=link)
+                duration, file_size, resolution = mp4_metadata.get(dlink) or self._get_video_metadata(dlink, link_type='mp4', referer=link)
                 duration = pretty_time(duration)
                 resltn = resolution.split('x')[-1]
+                # retain the link of the preferred (or healthy) mirror, if resolution is already available
+                if resltn in resolution_links:
+                    self.logger.debug(f'Resolution [{resltn}] already available from a preferred mirror. Skipping [{dlink}]')
+                    continue
                 resolution_links[resltn] = {
                     'resolution_size': resolution,
                     'downloadLink': dlink,
@@ -530,7 +698,10 @@ class BaseClient():
 
         for _res, _vals in details.items():
             info += f' | {_res}P ({_vals["resolution_size"]})' #| URL: {_vals["downloadLink"]}
-            if 'filesize_mb' in _vals: info += f' [~{_vals["filesize_mb"]} MB]'
+            if 'filesize_margin_mb' in _vals:
+                info += f' [~{_vals["filesize_mb"]} ±{_vals["filesize_margin_mb"]} MB]'
+            elif 'filesize_mb' in _vals:
+                info += f' [~{_vals["filesize_mb"]} MB]'
 
         self._colprint('results', info)
 
@@ -598,7 +769,8 @@ class BaseClient():
                 self._update_udb_dict(ep, {'episodeName': ep_name, 'error': error})
                 self.logger.error(f'{info} {error}')
 
-        final_dict = { k:v for k,v in self._get_udb_dict().items() }
+        with self.udb_dict_lock:
+            final_dict = { k:v for k,v in self._get_udb_dict().items() }
 
         return final_dict
 
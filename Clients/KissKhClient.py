@@ -2,6 +2,9 @@ __author__ = 'Prudhvi PLN'
 
 import re
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from quickjs import Context as quickjsContext
 from urllib.parse import quote_plus
 from Clients.BaseClient import BaseClient
@@ -25,10 +28,25 @@ class KissKhClient(BaseClient):
         self.hls_size_accuracy = config.get('hls_size_accuracy', 0)
         self.session = session if session else requests.Session()   
         self.timeout = config.get('request_timeout', 30)            
-        super().__init__(config.get('request_timeout', 30), session)
+        super().__init__(config.get('request_timeout', 30), session, config.get('http_cache'), config.get('resolution_cache_ttl', 0))
         self.logger.debug(f'KissKh Drama client initialized with {config = }')
+        # no. of search & series detail requests sent in parallel
+        self.max_parallel_search = max(1, config.get('max_parallel_search', 8))
+        # no. of episodes for which links are resolved in parallel
+        self.max_parallel_links = max(1, config.get('max_parallel_links', 1))
         self.token_generation_js_code = None
-        self.quickjs_context = None
+        self.token_js_lock = threading.Lock()
+        # quickjs context with token generation js code loaded, per token thread. A context is not thread-safe,
+        # so it is created and used only by the thread it belongs to.
+        self.token_context = threading.local()
+        self.token_lock = threading.Lock()
+        # tokens are generated in these threads, so that tokens of multiple episodes are generated in parallel.
+        # every thread warms its context as soon as it starts, so up to max_parallel_links contexts are loaded in the background.
+        self.token_executor = ThreadPoolExecutor(max_workers=self.max_parallel_links, thread_name_prefix='udb-kisskh-token-',
+                                                 initializer=self._init_token_context)
+        # generated tokens are re-used till they expire. key: (episode id, guid), value: (future of token, expiry time)
+        self.token_ttl = config.get('token_ttl', 300)
+        self.token_cache = {}
         # site specific details required to create token. Check dev-notes for more details.
         self.subGuid = "VgV52sWhwvBSf8BsM3BRY9weWiiCbtGp"
         self.viGuid = "62f176f3bb1b5b8e70e39932ad34a0c7"
@@ -54,27 +72,130 @@ class KissKhClient(BaseClient):
                 f"\n   | Episodes: {details.get('episodesCount', 'NA')} | Released: {details.get('year')} | Status: {details.get('status')}"
         self._colprint('results', line)
 
+    # step-4.1.1
+    def _create_token_context(self):
+        '''
+        create a quickjs context with the token generation js code from kisskh site loaded. Returns (context, token generation function).
+        '''
+        # js code to generate token from kisskh site. fetched only once.
+        with self.token_js_lock:
+            if self.token_generation_js_code is None:
+                self.logger.debug('Fetching token generation js code...')
+                soup = self._get_bsoup(self.base_url + 'index.html')
+                common_js_url = self.base_url + [ i['src'] for i in soup.select('script') if i.get('src') and 'common' in i['src'] ][0]
+                self.token_generation_js_code = self._send_request(common_js_url)
+
+        # js code is evaluated only once per context, which defines the token function in the context.
+        self.logger.debug('Creating quickjs context and loading token generation js code...')
+        quickjs_context = quickjsContext()
+        quickjs_context.eval(self.token_generation_js_code)
+
+        return quickjs_context, quickjs_context.get('_0x54b991')
+
+    # step-4.1.1
+    def _init_token_context(self):
+        '''
+        warm the quickjs context of the current token thread. On failure, context is created again when the first token is generated.
+        '''
+        try:
+            self._get_token_context()
+        except Exception as e:
+            # an exception here would break the token executor
+            self.logger.debug(f'Failed to warm quickjs context: {e}')
+
+    # step-4.1.1
+    def _get_token_context(self):
+        '''
+        returns the quickjs context of the current thread, created on first use
+        '''
+        if getattr(self.token_context, 'context', None) is None:
+            self.token_context.context = self._create_token_context()
+
+        return self.token_context.context
+
+    # step-4.1
+    def _generate_token(self, episode_id, uid):
+        token_context = self._get_token_context()
+        # call the token function directly, instead of evaluating the whole js code for every token
+        self.logger.debug(f'Generating token using {episode_id = } and {uid = }')
+        return token_context[1](episode_id, None, self.appVer, uid, self.platformVer, self.appName, self.appName, self.appName, self.appName, self.appName, self.appName)
+
+    # step-4.1
+    def _submit_tokens(self, episode_ids, uid):
+        '''
+        start generating the tokens of the episodes in parallel, unless they are already generated (or being generated). Returns dict of episode id and future of token.
+        '''
+        futures = {}
+        with self.token_lock:
+            now = time.monotonic()
+            for episode_id in episode_ids:
+                cached = self.token_cache.get((episode_id, uid))
+                if cached is None or cached[1] <= now:
+                    cached = self.token_cache[(episode_id, uid)] = (self.token_executor.submit(self._generate_token, episode_id, uid), now + self.token_ttl)
+                futures[episode_id] = cached[0]
+
+        return futures
+
+    # step-4.1
+    def _get_tokens(self, episode_ids, uid):
+        '''
+        create tokens for a list of episodes, in parallel. Tokens are re-used till they expire. Returns dict of episode id and token.
+        '''
+        tokens = {}
+        for episode_id, future in self._submit_tokens(episode_ids, uid).items():
+            try:
+                tokens[episode_id] = future.result()
+            except Exception:
+                # generate again on the next request
+                with self.token_lock:
+                    if self.token_cache.get((episode_id, uid), (None,))[0] is future:
+                        self.token_cache.pop((episode_id, uid))
+                raise
+
+        return tokens
+
     # step-4.1
     def _get_token(self, episode_id, uid):
         '''
         create token required to fetch stream & subtitle links
         '''
-        # js code to generate token from kisskh site
-        if self.token_generation_js_code is None:
-            self.logger.debug('Fetching token generation js code...')
-            soup = self._get_bsoup(self.base_url + 'index.html')
-            common_js_url = self.base_url + [ i['src'] for i in soup.select('script') if i.get('src') and 'common' in i['src'] ][0]
-            self.token_generation_js_code = self._send_request(common_js_url)
+        return self._get_tokens([episode_id], uid)[episode_id]
+
+    # step-1.2
+    def _fetch_series_details(self, series_id):
+        '''
+        fetch additional details of a search result
+        '''
+        self.logger.debug(f'Fetching additional details for series_id: {series_id}')
+        series_data = self._send_request(self.series_url + str(series_id), return_type='json')
+        item = {
+            'title': series_data['title'],
+            'series_id': series_id,
+            'country': series_data['country'],
+            'episodesCount': series_data['episodesCount'],
+            'series_type': series_data['type'],
+            'status': series_data['status'],
+            'episodes': series_data['episodes']
+        }
+        try:
+            item['year'] = series_data['releaseDate'].split('-')[0]
+        except:
+            item['year'] = 'XXXX'
+
+        return item
 
-        # quickjs context for evaluating js code
-        if self.quickjs_context is None:
-            self.logger.debug('Creating quickjs context...')
-            self.quickjs_context = quickjsContext()
+    # step-1.1
+    def _search_type(self, executor, search_key, code, search_limit):
+        '''
+        search for a search type and submit the detail requests of its results. Returns list of futures of search results.
+        '''
+        search_url = self.search_url + search_key + '&type=' + str(code)
+        search_data = self._send_request(search_url, return_type='json')[:search_limit]
+        # if len(search_data) == 0:
+        #     self.logger.error('Nothing here')
 
-        # evaluate js code to generate token
-        self.logger.debug(f'Evaluating js code to generate token using {episode_id = } and {uid = }')
-        token = self.quickjs_context.eval(self.token_generation_js_code + f'_0x54b991({episode_id}, null, "2.8.10", "{uid}", 4830201,  "kisskh", "kisskh", "kisskh", "kisskh", "kisskh", "kisskh")')
-        return token
+        # details of the results are fetched in parallel, without waiting for them here
+        return [ executor.submit(self._fetch_series_details, result['id']) for result in search_data ]
 
     # step-1
     def search(self, keyword, search_limit=5):
@@ -105,39 +226,38 @@ class KissKhClient(BaseClient):
         # url encode search keyword
         search_key = quote_plus(keyword)
 
-        for code, type in search_types.items():
-            if search_type and search_type != code:
-                continue
-            self._colprint('blurred', f"-------------- {type} --------------")
-            self.logger.debug(f'Searching for {type} with keyword: {keyword}')
-            search_url = self.search_url + search_key + '&type=' + str(code)
-            search_data = self._send_request(search_url, return_type='json')[:search_limit]
-            # if len(search_data) == 0:
-            #     self.logger.error('Nothing here')
-
-            # Get basic details available from the site
-            for result in search_data:
-                series_id = result['id']
-                self.logger.debug(f'Fetching additional details for series_id: {series_id}')
-                series_data = self._send_request(self.series_url + str(series_id), return_type='json')
-                item = {
-                    'title': series_data['title'],
-                    'series_id': series_id,
-                    'country': series_data['country'],
-                    'episodesCount': series_data['episodesCount'],
-                    'series_type': series_data['type'],
-                    'status': series_data['status'],
-                    'episodes': series_data['episodes']
-                }
+        # search all types and fetch details of all results in parallel. Results are shown in the same order as they arrive.
+        executor = ThreadPoolExecutor(max_workers=self.max_parallel_search, thread_name_prefix='udb-search-')
+        try:
+            type_futures = {}
+            for code, type in search_types.items():
+                if search_type and search_type != code:
+                    continue
+                self.logger.debug(f'Searching for {type} with keyword: {keyword}')
+                type_futures[type] = executor.submit(self._search_type, executor, search_key, code, search_limit)
+
+            for type, type_future in type_futures.items():
+                self._colprint('blurred', f"-------------- {type} --------------")
                 try:
-                    item['year'] = series_data['releaseDate'].split('-')[0]
-                except:
-                    item['year'] = 'XXXX'
+                    result_futures = type_future.result()
+                except Exception as e:
+                    self.logger.error(f'Failed to search for {type}. Error: {e}')
+                    continue
 
-                # Add index to every search result
-                search_results[idx] = item
-                self._show_search_results(idx, item)
-                idx += 1
+                # Get basic details available from the site
+                for result_future in result_futures:
+                    try:
+                        item = result_future.result()
+                    except Exception as e:
+                        self.logger.error(f'Failed to fetch details of a search result. Error: {e}')
+                        continue
+
+                    # Add index to every search result
+                    search_results[idx] = item
+                    self._show_search_results(idx, item)
+                    idx += 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
         return search_results
 
@@ -176,86 +296,155 @@ class KissKhClient(BaseClient):
                 fmted_name = re.sub(r'\b(\d$)', r'0\1', item.get('episodeName'))
                 self._colprint('results', f"{display_prefix}: {fmted_name}")
 
-    # step-4
-    def fetch_episode_links(self, episodes, ep_ranges):
+    # step-4.0.1
+    def _update_subs_decryption_details(self, episode, subtitles):
         '''
-        fetch only required episodes based on episode range provided
+        check if subtitles are encrypted and add decryption details to udb dict
         '''
-        download_links = {}
-        ep_start, ep_end, specific_eps = ep_ranges['start'], ep_ranges['end'], ep_ranges.get('specific_no', [])
-        display_prefix = 'Movie' if episodes[0].get('episodeName').endswith('Movie') else 'Episode'
+        # every subtitle can have it's own encryption type. So, check all subtitles for encryption and add decryption details to udb dict
+        encrypted_subs_details = {}
+        for k, v in subtitles.items():
+            self.logger.debug(f'Checking encryption type for {k} language...')
+            encryption_type = v.split('?')[0].split('.')[-1]
+            if encryption_type == 'txt':
+                encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY, 'iv': self.DECRYPT_SUBS_IV}
+            elif encryption_type == 'txt1':
+                encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY2, 'iv': self.DECRYPT_SUBS_IV2}
+            elif encryption_type == 'srt':
+                continue    # no encryption
+            else:
+                encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY3, 'iv': self.DECRYPT_SUBS_IV3}  # use default encryption
 
-        for episode in episodes:
-            # self.logger.debug(f'Current {episode = }')
+        if encrypted_subs_details:
+            self.logger.debug(f'Encrypted subtitles found. Adding decryption details to udb dict...')
+            self._update_udb_dict(episode.get('episode'), {'encrypted_subs_details': encrypted_subs_details})
 
-            if (float(episode.get('episode')) >= ep_start and float(episode.get('episode')) <= ep_end) or (float(episode.get('episode')) in specific_eps):
-                self.logger.debug(f'Processing {episode = }')
+    # step-4.0
+    def _fetch_episode_link(self, episode, display_prefix):
+        '''
+        fetch stream link, subtitles and resolution links for a single episode. Returns None if links are not available.
+        '''
+        self.logger.debug(f'Processing {episode = }')
+
+        # re-use the links resolved in an earlier run, if they are still valid
+        cached = self._get_cached_resolution(episode.get('episodeId'), referer=self.base_url)
+        if cached:
+            self.logger.debug(f'Using cached links for episode: {episode.get("episode")}')
+            self._update_udb_dict(episode.get('episode'), episode)
+            self._update_udb_dict(episode.get('episode'), {'streamLink': cached['streamLink'], 'refererLink': self.base_url})
+            if cached.get('subtitles') is not None:
+                self._update_udb_dict(episode.get('episode'), {'subtitles': cached['subtitles']})
+                self._update_subs_decryption_details(episode, cached['subtitles'])
+            self._show_episode_links(episode.get('episode'), cached['links'], display_prefix)
+            return cached['links']
+
+        self.logger.debug('Fetching stream token')
+        token = self._get_token(episode.get('episodeId'), self.viGuid)
+        self.logger.debug(f'Fetching stream link')
+        dl_links = self._send_request(self.episode_url.format(id=str(episode.get('episodeId'))) + token, return_type='json')
+        if dl_links is None:
+            self.logger.warning(f'Failed to fetch stream link for episode: {episode.get("episode")}')
+            return
+        link = dl_links.get('Video')
+        self.logger.debug(f'Extracted stream link: {link = }')
+
+        # skip if no stream link found
+        if link is None:
+            return
+
+        # check if link has countdown timer for upcoming releases
+        if 'tickcounter.com' in link:
+            self.logger.debug(f'Episode {episode.get("episode")} is not released yet')
+            self._show_episode_links(episode.get('episode'), {'error': 'Not Released Yet'}, display_prefix)
+            return
+
+        # add episode details & stream link to udb dict
+        self._update_udb_dict(episode.get('episode'), episode)
+        self._update_udb_dict(episode.get('episode'), {'streamLink': link, 'refererLink': self.base_url})
+
+        # get subtitles dictionary (key:value = language:link) and add to udb dict
+        subtitles = None
+        if episode.get('episodeSubs', 0) > 0:
+            self.logger.debug('Subtitles found. Fetching subtitles token')
+            token = self._get_token(episode.get('episodeId'), self.subGuid)
+            self.logger.debug('Fetching subtitles for the episode...')
+            subtitles = self._send_request(self.subtitles_url.format(id=str(episode.get('episodeId'))) + token, return_type='json')
+            subtitles = { sub['label']: sub['src'] for sub in subtitles }
+            self._update_udb_dict(episode.get('episode'), {'subtitles': subtitles})
+            self._update_subs_decryption_details(episode, subtitles)
+
+        # get actual download links
+        m3u8_links = [{'file': link, 'type': 'hls'}] if link.split('?')[0].endswith('.m3u8') else [{'file': link, 'type': 'mp4'}]
+        self.logger.debug(f'Fetching resolution streams from the stream link...')
+        try:
+            m3u8_links = self._get_download_links(m3u8_links, self.base_url, self.preferred_urls, self.blacklist_urls)
+            self.logger.debug(f'Extracted {m3u8_links = }')
+        except Exception as e:
+            self.logger.error(f'Failed to extract download links for episode: {episode.get("episode")}. Error: {e}')
+            return
 
-                self.logger.debug('Fetching stream token')
-                token = self._get_token(episode.get('episodeId'), self.viGuid)
-                self.logger.debug(f'Fetching stream link')
-                dl_links = self._send_request(self.episode_url.format(id=str(episode.get('episodeId'))) + token, return_type='json')
-                if dl_links is None:
-                    self.logger.warning(f'Failed to fetch stream link for episode: {episode.get("episode")}')
-                    continue
-                link = dl_links.get('Video')
-                self.logger.debug(f'Extracted stream link: {link = }')
+        self._show_episode_links(episode.get('episode'), m3u8_links, display_prefix)
 
-                # skip if no stream link found
-                if link is None:
-                    continue
+        # cache the resolved links, if all of them are resolved
+        if m3u8_links and 'error' not in m3u8_links:
+            urls = [link] + [ v['downloadLink'] for v in m3u8_links.values() if isinstance(v, dict) and v.get('downloadLink') ]
+            self._cache_resolution(episode.get('episodeId'), {'streamLink': link, 'subtitles': subtitles, 'links': m3u8_links}, urls)
 
-                # check if link has countdown timer for upcoming releases
-                if 'tickcounter.com' in link:
-                    self.logger.debug(f'Episode {episode.get("episode")} is not released yet')
-                    self._show_episode_links(episode.get('episode'), {'error': 'Not Released Yet'}, display_prefix)
-                    continue
+        return m3u8_links
 
-                # add episode details & stream link to udb dict
-                self._update_udb_dict(episode.get('episode'), episode)
-                self._update_udb_dict(episode.get('episode'), {'streamLink': link, 'refererLink': self.base_url})
-
-                # get subtitles dictionary (key:value = language:link) and add to udb dict
-                if episode.get('episodeSubs', 0) > 0:
-                    self.logger.debug('Subtitles found. Fetching subtitles token')
-                    token = self._get_token(episode.get('episodeId'), self.subGuid)
-                    self.logger.debug('Fetching subtitles for the episode...')
-                    subtitles = self._send_request(self.subtitles_url.format(id=str(episode.get('episodeId'))) + token, return_type='json')
-                    subtitles = { sub['label']: sub['src'] for sub in subtitles }
-                    self._update_udb_dict(episode.get('episode'), {'subtitles': subtitles})
-                    # check if subtitles are encrypted and add decryption details to udb dict
-                    # every subtitle can have it's own encryption type. So, check all subtitles for encryption and add decryption details to udb dict
-                    encrypted_subs_details = {}
-                    for k, v in subtitles.items():
-                        self.logger.debug(f'Checking encryption type for {k} language...')
-                        encryption_type = v.split('?')[0].split('.')[-1]
-                        if encryption_type == 'txt':
-                            encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY, 'iv': self.DECRYPT_SUBS_IV, 'decrypter': self._aes_decrypt}
-                        elif encryption_type == 'txt1':
-                            encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY2, 'iv': self.DECRYPT_SUBS_IV2, 'decrypter': self._aes_decrypt}
-                        elif encryption_type == 'srt':
-                            continue    # no encryption
-                        else:
-                            encrypted_subs_details[k] = {'key': self.DECRYPT_SUBS_KEY3, 'iv': self.DECRYPT_SUBS_IV3, 'decrypter': self._aes_decrypt}  # use default encryption
-
-                    if encrypted_subs_details:
-                        self.logger.debug(f'Encrypted subtitles found. Adding decryption details to udb dict...')
-                        self._update_udb_dict(episode.get('episode'), {'encrypted_subs_details': encrypted_subs_details})
-
-                # get actual download links
-                m3u8_links = [{'file': link, 'type': 'hls'}] if link.split('?')[0].endswith('.m3u8') else [{'file': link, 'type': 'mp4'}]
-                self.logger.debug(f'Fetching resolution streams from the stream link...')
+    # step-4
+    def iter_episode_links(self, episodes, ep_ranges):
+        '''
+        fetch only required episodes based on episode range provided.
+        Yields (episode number, resolution links) as soon as links of every episode are resolved, so that it can be downloaded while remaining episodes are being resolved.
+        '''
+        ep_start, ep_end, specific_eps = ep_ranges['start'], ep_ranges['end'], ep_ranges.get('specific_no', [])
+        display_prefix = 'Movie' if episodes[0].get('episodeName').endswith('Movie') else 'Episode'
+        selected_episodes = [ episode for episode in episodes if (float(episode.get('episode')) >= ep_start and float(episode.get('episode')) <= ep_end) or (float(episode.get('episode')) in specific_eps) ]
+
+        # start generating the tokens in the background, so that they are ready by the time links of the episodes are resolved.
+        # Not required for the episodes with cached links.
+        for episode in selected_episodes:
+            if self.resolution_cache is None or self.resolution_cache.get(self.__class__.__name__, episode.get('episodeId'))[0] is None:
+                self._submit_tokens([episode.get('episodeId')], self.viGuid)
+                if episode.get('episodeSubs', 0) > 0: self._submit_tokens([episode.get('episodeId')], self.subGuid)
+
+        if self.max_parallel_links == 1 or len(selected_episodes) <= 1:
+            for episode in selected_episodes:
+                # self.logger.debug(f'Current {episode = }')
                 try:
-                    m3u8_links = self._get_download_links(m3u8_links, self.base_url, self.preferred_urls, self.blacklist_urls)
-                    self.logger.debug(f'Extracted {m3u8_links = }')
+                    m3u8_links = self._fetch_episode_link(episode, display_prefix)
                 except Exception as e:
-                    self.logger.error(f'Failed to extract download links for episode: {episode.get("episode")}. Error: {e}')
+                    self.logger.error(f'Failed to fetch links for episode: {episode.get("episode")}. Error: {e}')
                     continue
+                if m3u8_links is not None:
+                    yield episode.get('episode'), m3u8_links
+            return
+
+        # resolve links of multiple episodes in parallel, but yield them in the order of episodes
+        parallel = min(self.max_parallel_links, len(selected_episodes))
+        self.logger.debug(f'Resolving links of {len(selected_episodes)} episodes with {parallel} workers...')
+        executor = ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='udb-kisskh-')
+        try:
+            futures = [ (episode, executor.submit(self._fetch_episode_link, episode, display_prefix)) for episode in selected_episodes ]
+            for episode, future in futures:
+                try:
+                    m3u8_links = future.result()
+                except Exception as e:
+                    self.logger.error(f'Failed to fetch links for episode: {episode.get("episode")}. Error: {e}')
+                    continue
+                if m3u8_links is not None:
+                    yield episode.get('episode'), m3u8_links
+        finally:
+            # cancel pending episodes, if the caller stopped consuming the links
+            executor.shutdown(wait=True, cancel_futures=True)
 
-                download_links[episode.get('episode')] = m3u8_links
-                self._show_episode_links(episode.get('episode'), m3u8_links, display_prefix)
-
-        return download_links
+    # step-4
+    def fetch_episode_links(self, episodes, ep_ranges):
+        '''
+        fetch only required episodes based on episode range provided
+        '''
+        return { ep: m3u8_links for ep, m3u8_links in self.iter_episode_links(episodes, ep_ranges) }
 
     # step-5
     def set_out_names(self, target_series):
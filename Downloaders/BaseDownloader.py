@@ -1,22 +1,49 @@
 __author__ = 'Prudhvi PLN'
 
+import errno
+import heapq
+import io
+import itertools
 import logging
 import os
+import random
+import re
 import requests
+import socket
 import sys
-import http.client
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from shutil import rmtree
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from functools import partial
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from shutil import copyfileobj, copystat, rmtree
 from tqdm.auto import tqdm
 
-from Utils.commons import colprint, exec_os_cmd, retry, PRINT_THEMES, DISPLAY_COLORS
+from Utils.commons import colprint, exec_os_cmd, DownloadError, DownloadSuperseded, PRINT_THEMES, DISPLAY_COLORS
+from Utils.BandwidthLimiter import BandwidthLimiter
+from Downloaders.ChunkBitmap import ChunkBitmap
+from Downloaders.ConcurrencyController import ConcurrencyController
+from Downloaders.DiskWriter import DiskWriter
+from Downloaders.HttpConnectionPool import HttpConnectionPool
+from Downloaders.ResumeJournal import ResumeJournal
+from Downloaders.SubtitleDecrypter import SubtitleDecrypter
+from Utils.HostHealthRegistry import CircuitOpenError, HostHealthRegistry
 
 
 class BaseDownloader():
     '''
     Download Client for downloading files directly using requests and http.client
     '''
-    def __init__(self, dl_config, ep_details, session=None):
+    # min no. of completed segments/chunks required to decide if a request is straggling
+    HEDGE_MIN_SAMPLES = 10
+    # interval (in seconds) to look for straggling requests
+    HEDGE_CHECK_INTERVAL = 0.5
+
+    def __init__(self, dl_config, ep_details, session=None, connection_budget=None, memory_budget=None):
         # logger init
         self.logger = logging.getLogger()
         # set downloader configuration
@@ -26,6 +53,13 @@ class BaseDownloader():
         if ep_details.get('type', '') == 'tv':
             self.out_dir = f"{self.out_dir}{os.sep}Season-{ep_details['season']}"
         self.concurrency = None if dl_config.get('concurrency_per_file', 'auto') == 'auto' else dl_config['concurrency_per_file']
+        # size of the blocks in which the streamed data is written
+        self.write_block_size = 64*1024
+        # buffer of every worker thread, into which the streamed data is read (with http.client)
+        self.buffers = threading.local()
+        # bounds for adapting the concurrency to network conditions, if concurrency is auto
+        self.min_concurrency = dl_config.get('min_concurrency_per_file', 2)
+        self.max_concurrency = dl_config.get('max_concurrency_per_file', 64)
         self.parent_temp_dir = os.path.join(f'{self.out_dir}', 'temp_dir') if dl_config.get('temp_download_dir', 'auto') == 'auto' else dl_config['temp_download_dir']
         self.temp_dir = os.path.join(f"{self.parent_temp_dir}", f"{self.out_file.replace('.mp4','')}") #create temp directory per episode
         self.request_timeout = dl_config.get('request_timeout', 30)
@@ -33,13 +67,61 @@ class BaseDownloader():
         self.subtitles = ep_details.get('subtitles', {})
         # special case for encrypted subtitles in kisskh client
         self.encrypted_subs_details = ep_details.get('encrypted_subs_details', {})
+        # subtitles are downloaded in parallel, alongside the video
+        self.max_parallel_subtitles = dl_config.get('max_parallel_subtitles', 8)
+        self.subtitle_futures = None
+        # decrypters of the encrypted subtitles by key/IV, shared by the subtitles downloaded in parallel
+        self.subtitle_decrypters = {}
+        self.subtitle_lock = threading.Lock()
         self.thread_name_prefix = 'udb-mp4-'
+        # download mp4 into a single preallocated file, instead of merging chunk files at the end
+        self.preallocate = dl_config.get('mp4_preallocate', True)
+        # verify checksum of the segments/chunks recorded in resume journal, before reusing them
+        self.verify_resume = dl_config.get('verify_resume', False)
+        # semaphore shared across parallel episode downloads to cap the total number of open connections
+        self.connection_budget = connection_budget
+        if connection_budget is not None and isinstance(dl_config.get('max_total_connections'), int):
+            # more workers than the budget would only wait for the connection slots
+            self.max_concurrency = max(1, min(self.max_concurrency, dl_config['max_total_connections']))
+            self.min_concurrency = min(self.min_concurrency, self.max_concurrency)
+            if self.concurrency: self.concurrency = min(self.concurrency, dl_config['max_total_connections'])
+        # bytes held in memory by the downloads, shared across parallel episode downloads. None if unlimited.
+        self.memory_budget = memory_budget
+        # write the segments/chunks to disk in dedicated writer threads, so that slow disks do not stall the network workers. 0 to disable.
+        self.disk_writer_threads = dl_config.get('disk_writer_threads', 0)
+        self.disk_writer_queue_size = dl_config.get('disk_writer_queue_size', 16)
+        self.disk_fsync = dl_config.get('disk_fsync', 'none')
+        self.disk_writer = None
+        # writes submitted by the segment/chunk being downloaded in every worker thread, so that its failed writes are retried
+        self.worker_writes = threading.local()
+        # timing of the request being run in every worker thread, so that its responses can be aborted once its hedged duplicate wins
+        self.worker_requests = threading.local()
+        # failed segments/chunks are re-queued with jittered exponential backoff, instead of blocking the worker threads
+        self.segment_retries = dl_config.get('segment_retries', 3)
+        self.retry_backoff = dl_config.get('retry_backoff', 2)
+        self.max_retry_delay = dl_config.get('max_retry_delay', 60)
+        # duplicate the requests slower than this percentile of completed ones, once workers are idle. 0 to disable.
+        self.hedge_percentile = dl_config.get('hedge_percentile', 95)
+        # segments/chunks rejected as their host is down are re-queued without using up their retries, till the host is down for this long (in seconds)
+        self.circuit_max_wait = dl_config.get('circuit_breaker_max_wait', 300)
+        # health of the hosts is shared across downloaders & clients, to stop sending requests to a host which is down
+        self.host_health = HostHealthRegistry.get_registry()
+        self.host_health.configure(dl_config.get('circuit_breaker_failures'), dl_config.get('circuit_breaker_cooldown'))
+        # bandwidth limits are shared across downloaders, so that the limit applies to all the parallel downloads together
+        self.bandwidth_limiter = BandwidthLimiter.get_limiter()
+        self.bandwidth_limiter.configure(dl_config.get('bandwidth_limit', 0), dl_config.get('bandwidth_host_limits'),
+                                         dl_config.get('bandwidth_schedule'), dl_config.get('bandwidth_control_file'))
 
         # create a requests session and use across to re-use cookies
         self.req_session = session if session else requests.Session()
 
         # set http client usage based on config. As on Feb 21 2025, kisskh works with only http.client
         self.use_http_client = dl_config.get('use_http_client', False)
+        if self.use_http_client:
+            # keep-alive connections are shared across downloaders. By default, pool size is same as concurrency per file.
+            pool_size = dl_config.get('http_pool_size', 'auto')
+            pool_size = (self.concurrency or self.max_concurrency) if pool_size == 'auto' else pool_size
+            self.http_pool = HttpConnectionPool.get_shared_pool(pool_size)
 
         self.req_session.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36",
@@ -60,45 +142,172 @@ class BaseDownloader():
 
     def _get_raw_stream_data(self, url, stream=True, header=None):
         '''
-        Fetch raw stream data using requests or http.client
+        Fetch raw stream data using requests or http.client. Fails fast if the host is marked unhealthy.
         '''
-        if self.use_http_client:
-            # Use http.client for the request
-            parsed_url = requests.utils.urlparse(url)
-            conn = http.client.HTTPSConnection(parsed_url.netloc, timeout=self.request_timeout)
-            path = parsed_url.path + '?' + parsed_url.query
-            headers = self.req_session.headers.copy()
-            if header: headers.update(header)
-            conn.request("GET", path, headers=headers)
-            response = conn.getresponse()
-            if response.status in [200, 206]:  # 206 means partial data (i.e., for chunked downloads)
-                return response
+        # fail fast instead of waiting for request timeout on a host which is down
+        self.host_health.check(url)
+        headers = self.req_session.headers.copy()
+        if header: headers.update(header)
+        start_time = time.monotonic()
+        try:
+            if self.use_http_client:
+                # Use http.client for the request, re-using the pooled connections
+                response = self.http_pool.request(url, headers, self.request_timeout)
+                status = response.status
             else:
-                raise Exception(f'Failed with response code: {response.status}')
+                # Use requests for the request
+                response = self.req_session.get(url, stream=stream, timeout=self.request_timeout, headers=headers)
+                status = response.status_code
+        except Exception:
+            self.host_health.record(url, False)
+            raise
+
+        # host is considered healthy unless it is failing with server errors
+        self.host_health.record(url, status < 500, time.monotonic() - start_time)
+        if status in [200, 206]:  # 206 means partial data (i.e., for chunked downloads)
+            timing = getattr(self.worker_requests, 'timing', None)
+            if timing is not None:
+                timing['responses'].append(response)
+                # request was aborted before its response was received
+                if timing.get('aborted'):
+                    response.close()
+                    raise DownloadSuperseded(f'Request to {url} aborted, as it is downloaded by hedged request')
+            return response
         else:
-            # Use requests for the request
-            headers = self.req_session.headers.copy()
-            if header: headers.update(header)
-            response = self.req_session.get(url, stream=stream, timeout=self.request_timeout, headers=headers)
-            if response.status_code in [200, 206]:  # 206 means partial data (i.e., for chunked downloads)
-                return response
-            else:
-                raise Exception(f'Failed with response code: {response.status_code}')
+            response.close()
+            raise DownloadError(f'Failed with response code: {status}', status, self._get_retry_after(response.headers))
+
+    def _get_retry_after(self, headers):
+        '''
+        Parse Retry-After header, sent either as seconds or as HTTP date. Returns delay in seconds, or None if not available.
+        '''
+        retry_after = headers.get('Retry-After')
+        if not retry_after:
+            return None
+
+        try:
+            return max(0, float(retry_after))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _iter_stream_data(self, response, block_size):
+        '''
+        iterate over the response data in blocks, for both requests and http.client.
+        Note: with http.client, blocks are views of a buffer re-used by the worker. So, a block is valid only till the next block is read.
+        '''
+        if self.use_http_client:
+            blocks = self._iter_readinto(response, block_size)
+        else:
+            blocks = response.iter_content(block_size)
+
+        return self.bandwidth_limiter.iter_throttled(blocks, self._get_response_host(response))
+
+    def _get_response_host(self, response):
+        # host which sent the response (after redirects, with requests), for per host bandwidth limits
+        return response.conn.host if self.use_http_client else urlsplit(response.url).hostname
+
+    def _iter_readinto(self, response, block_size):
+        '''
+        read the response into a buffer preallocated per worker thread, instead of allocating a new bytes object for every block
+        '''
+        buffer = getattr(self.buffers, 'buffer', None)
+        if buffer is None or len(buffer) != block_size:
+            buffer = self.buffers.buffer = bytearray(block_size)
+
+        with memoryview(buffer) as view:
+            while size := response.readinto(buffer):
+                yield view[:size]
+
+    def _reserve_memory(self, size):
+        '''
+        hold the bytes from the shared memory budget while the block is running. Does nothing if the budget is unlimited.
+        '''
+        return self.memory_budget.reserve(size) if self.memory_budget else nullcontext()
 
     def _get_stream_data(self, url, to_text=False, stream=False):
         response = self._get_raw_stream_data(url, stream)
         if self.use_http_client:
             data = response.read()
+            self.bandwidth_limiter.throttle(self._get_response_host(response), len(data))
             return data.decode('utf-8') if to_text else data
         else:
+            self.bandwidth_limiter.throttle(self._get_response_host(response), len(response.content))
             return response.text if to_text else response.content
 
     def _create_out_dirs(self):
         self.logger.debug(f'Creating output directories: {self.out_dir}')
         os.makedirs(self.out_dir, exist_ok=True)
         os.makedirs(self.temp_dir, exist_ok=True)
+        # journal of completed segments/chunks to resume interrupted downloads
+        self.journal = ResumeJournal(os.path.join(self.temp_dir, 'resume.journal'), self.verify_resume)
+
+    def _copy_file_data(self, src, dst):
+        '''
+        copy the data of src file to dst file (from their current positions) within the kernel, using copy_file_range/sendfile.
+        Falls back to copying through python buffers, where they are not supported (platform/file system).
+        '''
+        dst.flush()
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        src_offset, dst_offset = src.tell(), dst.tell()
+        size = os.fstat(src_fd).st_size - src_offset
+        copied = 0
+
+        copy_funcs = []
+        if hasattr(os, 'copy_file_range'):
+            # can be a reflink or a server-side copy (NFS/SMB), without the data passing through user space
+            copy_funcs.append(lambda count, src_pos, dst_pos: os.copy_file_range(src_fd, dst_fd, count, src_pos, dst_pos))
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            def sendfile(count, src_pos, dst_pos):
+                # sendfile writes at the current position of dst
+                os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+                return os.sendfile(dst_fd, src_fd, src_pos, count)
+            copy_funcs.append(sendfile)
+
+        for copy_func in copy_funcs:
+            try:
+                while copied < size and (sent := copy_func(size - copied, src_offset + copied, dst_offset + copied)) > 0:
+                    copied += sent
+                break
+            except OSError as e:
+                self.logger.debug(f'Kernel copy failed after {copied} bytes with error: {e}. Trying the next method.')
 
-    # Modified _remove_out_dirs method in BaseDownloader.py
+        # copy the remaining data (if any) through buffers
+        src.seek(src_offset + copied)
+        dst.seek(dst_offset + copied)
+        if copied < size:
+            copyfileobj(src, dst, 1024*1024)
+
+        return size
+
+    def _move_file(self, src, dest):
+        '''
+        move the file by renaming it atomically. If src & dest are on different file systems, copy it within the kernel and remove the src.
+
+        Returns: True if moved, else False
+        '''
+        try:
+            try:
+                os.replace(src, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # copy to a temp file and rename, so that a partial file is never left at the destination
+                part_file = f'{dest}.part'
+                with open(src, 'rb') as src_f, open(part_file, 'wb') as dest_f:
+                    self._copy_file_data(src_f, dest_f)
+                copystat(src, part_file)
+                os.replace(part_file, dest)
+                os.remove(src)
+            self.logger.debug(f"Moved file from {src} to {dest}")
+            return True
+        except Exception as e:
+            self.logger.warning(f"Failed to move file from {src} to {dest}: {e}")
+            return False
 
     def _remove_out_dirs(self):
         """Process subtitle files, move them to output directory, and clean up temp directory"""
@@ -108,9 +317,6 @@ class BaseDownloader():
         # Make sure output directory exists
         os.makedirs(self.out_dir, exist_ok=True)
     
-        # Keep track of processed files to ensure we don't delete needed files
-        processed_files = []
-    
         # Language code mapping (add more as needed)
         language_mappings = {
             'arabic': 'ar',
@@ -172,54 +378,30 @@ class BaseDownloader():
                         new_path = os.path.join(self.out_dir, new_filename)
                     
                         # Move and rename file
-                        import shutil
-                        shutil.copy2(original_path, new_path)
-                        processed_files.append(original_path)
-                        subtitle_count += 1
+                        if self._move_file(original_path, new_path):
+                            subtitle_count += 1
                         self.logger.debug(f"Processed subtitle: {file} → {new_filename}")
                     
                     except Exception as e:
                         self.logger.warning(f"Failed to process subtitle file {file}: {e}")
     
-        # Also ensure video file is in output directory if it exists in temp
-        mp4_files = [f for f in os.listdir(self.temp_dir) if f.endswith('.mp4')]
+        # Also ensure video file is in output directory if it exists in temp. Other mp4 files (like init sections of segments) are not moved.
+        mp4_files = [f for f in os.listdir(self.temp_dir) if f == self.out_file]
         for mp4_file in mp4_files:
             try:
                 src_path = os.path.join(self.temp_dir, mp4_file)
                 dest_path = os.path.join(self.out_dir, mp4_file)
                 if os.path.exists(src_path) and not os.path.exists(dest_path):
-                    import shutil
-                    shutil.copy2(src_path, dest_path)
-                    processed_files.append(src_path)
-                    self.logger.debug(f"Moved video file: {mp4_file} to {self.out_dir}")
+                    self._move_file(src_path, dest_path)
             except Exception as e:
                 self.logger.warning(f"Failed to move video file {mp4_file}: {e}")
     
         self.logger.debug(f"Processed {subtitle_count} subtitle files")
     
-        # Now clean up temp directory - remove processed files first
-        for file_path in processed_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                self.logger.warning(f"Failed to remove processed file {file_path}: {e}")
-    
-        # Remove any remaining files in temp_dir
-        try:
-            for item in os.listdir(self.temp_dir):
-                item_path = os.path.join(self.temp_dir, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-                else:
-                    os.remove(item_path)
-        except Exception as e:
-            self.logger.warning(f"Error cleaning remaining files in temp dir: {e}")
-    
-        # Now remove the temp directory itself
+        # Remove the temp directory along with the remaining files, in a single pass
         try:
             if os.path.exists(self.temp_dir):
-                os.rmdir(self.temp_dir)
+                rmtree(self.temp_dir)
                 self.logger.debug("Removed temp_dir after moving files.")
         except Exception as e:
             self.logger.warning(f"Failed to remove temp_dir: {e}")
@@ -267,49 +449,293 @@ class BaseDownloader():
         end = start + self.chunk_size - 1
         return {'Range': f'bytes={start}-{end}'}
 
-    @retry()
     def _download_chunk(self, chunk_details):
         '''
         download chunk file from download link based on defined chunk size. Reuse if already downloaded.
 
-        Returns: (download_status, progress_bar_increment)
+        Returns: (download_status, progress_bar_increment). Raises DownloadError on failure.
         '''
+        dl_link, chunk_header, chunk_name = chunk_details
+        chunk_file = os.path.join(f'{self.temp_dir}', f'{chunk_name}')
+        # temp file is unique per request, as a hedged request may be downloading the same chunk
+        part_file = f'{chunk_file}.{threading.get_ident()}.part'
         try:
-            dl_link, chunk_header, chunk_name = chunk_details
-            chunk_file = os.path.join(f'{self.temp_dir}', f'{chunk_name}')
-
             # check if the chunk is already downloaded
-            if os.path.isfile(chunk_file) and os.path.getsize(chunk_file) > 0:
-                return (f'Chunk [{chunk_name}] already exists. Reusing.', os.path.getsize(chunk_file))
+            if self.journal.is_complete(chunk_name, chunk_file):
+                return (f'Chunk [{chunk_name}] already exists. Reusing.', self.journal.entries[chunk_name][0])
 
             # get the data for the chunk size defined in the header
-            response = self._get_raw_stream_data(dl_link, False, chunk_header)
-
-            # capture the size to update progress bar
-            size = 0 
-            with open(chunk_file, 'wb') as f:
-                if isinstance(response, http.client.HTTPResponse):
-                    while True:
-                        chunk = response.read(self.chunk_size)
-                        if not chunk:
-                            break
+            response = self._get_raw_stream_data(dl_link, True, chunk_header)
+
+            if self.disk_writer:
+                # hand over the chunk to the disk writer, so that this worker moves on to the next request
+                data = bytearray()
+                for chunk in self._iter_stream_data(response, self.write_block_size):
+                    # stop if the other request of a hedged chunk has completed it
+                    if self.journal.is_complete(chunk_name):
+                        response.close()
+                        raise DownloadSuperseded(f'Chunk [{chunk_name}] downloaded by hedged request')
+                    data += chunk
+                self._submit_write(data, self._save_file, chunk_name, data, chunk_file)
+
+                return (f'Chunk [{chunk_name}] downloaded', len(data))
+
+            # capture the size to update progress bar. write to a temp file, so that partial chunk is never reused.
+            size, crc = 0, 0
+            with self._reserve_memory(self.write_block_size), open(part_file, 'wb') as f:
+                for chunk in self._iter_stream_data(response, self.write_block_size):
+                    # stop if the other request of a hedged chunk has completed it
+                    if self.journal.is_complete(chunk_name):
+                        response.close()
+                        raise DownloadSuperseded(f'Chunk [{chunk_name}] downloaded by hedged request')
+                    if chunk:
                         size += f.write(chunk)
-                else:
-                    for chunk in response.iter_content(self.chunk_size):
-                        if chunk:
-                            size += f.write(chunk)
+                        crc = zlib.crc32(chunk, crc)
+
+            os.replace(part_file, chunk_file)
+            self.journal.record(chunk_name, size, crc)
+
+            return (f'Chunk [{chunk_name}] downloaded', size)
+
+        except (DownloadSuperseded, CircuitOpenError):
+            raise
+
+        except Exception as e:
+            raise DownloadError(f'Chunk download failed [{chunk_name}] due to: {e}', getattr(e, 'status', None), getattr(e, 'retry_after', None))
+
+        finally:
+            if os.path.isfile(part_file): os.remove(part_file)
+
+    def _get_item_url(self, item):
+        '''
+        url of the segment/chunk details passed to the download functions
+        '''
+        return item[0]
+
+    def _run_with_budget(self, download_func, url, controller=None):
+        '''
+        run the download function within the adaptive concurrency limit and by holding a slot from the shared connection budget, if defined
+        '''
+        # if the host is being probed after failures, wait for the result before taking any slots
+        self.host_health.wait_for_probe(self._get_item_url(url))
+        connection_slot = self.connection_budget if self.connection_budget is not None else nullcontext()
+        if controller is not None:
+            return controller.run(download_func, url, slot=connection_slot)
+
+        with connection_slot:
+            return download_func(url)
 
+    def _write_at(self, fd, data, offset):
+        '''
+        write data at the given offset of the preallocated file. Falls back to seek & write, where pwrite is not available (Windows).
+        '''
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(fd, data, offset)
+
+        with self.out_fd_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def _download_chunk_at_offset(self, chunk_details):
+        '''
+        download chunk from download link and write it at its offset in the preallocated file. Reuse if already downloaded.
+
+        Returns: (download_status, progress_bar_increment). Raises DownloadError on failure.
+        '''
+        dl_link, chunk_no, start, end = chunk_details
+        chunk_name = f'{self.out_file}.chunk{chunk_no}'
+        fd = None
+        try:
+            # check if the chunk is already downloaded
+            if self.chunk_bitmap.is_set(chunk_no):
+                return (f'Chunk [{chunk_name}] already exists. Reusing.', end - start + 1)
+
+            # get the data for the chunk range
+            response = self._get_raw_stream_data(dl_link, True, {'Range': f'bytes={start}-{end}'})
+
+            if self.disk_writer:
+                # hand over the chunk to the disk writer, so that this worker moves on to the next request
+                data = bytearray()
+                for block in self._iter_stream_data(response, self.write_block_size):
+                    # stop if the other request of a hedged chunk has completed it
+                    if self.chunk_bitmap.is_set(chunk_no):
+                        response.close()
+                        raise DownloadSuperseded(f'Chunk [{chunk_name}] downloaded by hedged request')
+                    data += block
+                if len(data) != end - start + 1:
+                    raise Exception(f'Received {len(data)} bytes instead of {end - start + 1} bytes')
+                self._submit_write(data, self._save_chunk_at_offset, chunk_no, data, start)
+
+                return (f'Chunk [{chunk_name}] downloaded', len(data))
+
+            # write the data as it is received, without holding the whole chunk in memory.
+            # a duplicate of the file descriptor is used, as the losing request of a hedged chunk may still be running after the file is closed.
+            fd = os.dup(self.out_fd)
+            size = 0
+            with self._reserve_memory(self.write_block_size):
+                for data in self._iter_stream_data(response, self.write_block_size):
+                    # stop if the other request of a hedged chunk has completed it. Data written so far is identical, so it is harmless.
+                    if self.chunk_bitmap.is_set(chunk_no):
+                        response.close()
+                        raise DownloadSuperseded(f'Chunk [{chunk_name}] downloaded by hedged request')
+                    if data:
+                        size += self._write_at(fd, data, start + size)
+
+            if size != end - start + 1:
+                raise Exception(f'Received {size} bytes instead of {end - start + 1} bytes')
+
+            self.chunk_bitmap.set(chunk_no)
             return (f'Chunk [{chunk_name}] downloaded', size)
 
+        except (DownloadSuperseded, CircuitOpenError):
+            raise
+
         except Exception as e:
-            return (f'\nERROR: Chunk download failed [{chunk_name}] due to: {e}', 0)
+            raise DownloadError(f'Chunk download failed [{chunk_name}] due to: {e}', getattr(e, 'status', None), getattr(e, 'retry_after', None))
+
+        finally:
+            if fd is not None: os.close(fd)
+
+    def _save_file(self, item_name, data, file):
+        '''
+        write the buffer of a segment/chunk to its file and record it in resume journal. Runs in a disk writer thread.
+        '''
+        # the other request of a hedged segment/chunk has already written it
+        if self.journal.is_complete(item_name):
+            return
+
+        part_file = f'{file}.{threading.get_ident()}.part'
+        try:
+            with open(part_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                self.disk_writer.fsync(f.fileno(), file)
+            os.replace(part_file, file)
+            self.journal.record(item_name, len(data), zlib.crc32(data))
+        finally:
+            if os.path.isfile(part_file): os.remove(part_file)
+
+    def _save_chunk_at_offset(self, chunk_no, data, start):
+        '''
+        write the buffer of a chunk at its offset in the preallocated file and mark it completed. Runs in a disk writer thread.
+        '''
+        if self.chunk_bitmap.is_set(chunk_no):
+            return
+
+        size = 0
+        with memoryview(data) as view:
+            while size < len(data):
+                size += self._write_at(self.out_fd, view[size:], start + size)
+        self.disk_writer.fsync(self.out_fd, self.out_fd_file)
+        self.chunk_bitmap.set(chunk_no)
+
+    def _submit_write(self, data, write_func, *args):
+        '''
+        hand over the buffer to the disk writer. Its size is held from the memory budget till it is written.
+        Write is tracked against the segment/chunk being downloaded in this thread, so that it is retried if the write fails.
+        '''
+        if self.memory_budget: self.memory_budget.acquire(len(data))
+        try:
+            future = self.disk_writer.submit(write_func, *args)
+        except BaseException:
+            if self.memory_budget: self.memory_budget.release(len(data))
+            raise
+
+        if self.memory_budget: future.add_done_callback(lambda _: self.memory_budget.release(len(data)))
+        writes = getattr(self.worker_writes, 'writes', None)
+        if writes is not None: writes.append(future)
+
+    def _start_disk_writer(self, name):
+        '''
+        start the disk writer stage for the download, if enabled
+        '''
+        self.disk_writer = None
+        if self.disk_writer_threads > 0:
+            self.logger.debug(f'[{name}] Writing to disk using {self.disk_writer_threads} writer threads with queue size {self.disk_writer_queue_size} and fsync policy: {self.disk_fsync}')
+            self.disk_writer = DiskWriter(self.disk_writer_threads, self.disk_writer_queue_size, self.disk_fsync, name)
+            self.disk_writer.start()
+
+    def _get_retry_delay(self, attempt, error):
+        '''
+        Delay before the next attempt of a failed segment/chunk. Retry-After sent by the server is honored (capped to max delay),
+        else exponential backoff with jitter, so that the failed requests are not retried in lock-step.
+        '''
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_delay)
+
+        backoff = min(self.retry_backoff * 2 ** (attempt - 1), self.max_retry_delay)
+        return random.uniform(backoff / 2, backoff)
+
+    def _timed_download(self, timing, download_func, url):
+        '''
+        run the download function, capturing the time when the request is actually started
+        '''
+        timing['start'] = time.monotonic()
+        timing['responses'] = []
+        self.worker_writes.writes = timing['writes'] = []
+        self.worker_requests.timing = timing
+        try:
+            return download_func(url)
+        except DownloadSuperseded:
+            raise
+        except Exception as e:
+            # read failed as the request was aborted, not due to the host
+            if timing.get('aborted'):
+                raise DownloadSuperseded('Request aborted, as it is downloaded by hedged request') from e
+            raise
+        finally:
+            self.worker_writes.writes = None
+            self.worker_requests.timing = None
+
+    def _abort_request(self, timing):
+        '''
+        stop a running request, by shutting down the connections of its responses. So that its blocked reads fail right away,
+        instead of waiting for the rest of the data. Used to stop the losing request of a hedged segment/chunk.
+        '''
+        timing['aborted'] = True
+        for response in list(timing.get('responses', [])):
+            if self.use_http_client:
+                # connection is already handed back to the pool, once the response is fully read
+                conn = None if response.released else response.conn
+            else:
+                conn = response.raw.connection
+            sock = getattr(conn, 'sock', None)
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _get_hedge_threshold(self, latencies):
+        '''
+        time after which an in-flight request is considered straggling, based on the completed ones
+        '''
+        if not self.hedge_percentile or len(latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * self.hedge_percentile // 100)]
 
     def _multi_threaded_download(self, download_func, urls, **metadata):
         reused_segments = 0
         failed_segments = 0
+        retried_segments = 0
+        hedged_segments = 0
+        retry_seq = itertools.count()   # tie-breaker for retries due at the same time
         ep_no = self._get_display_prefix()
         type = metadata.pop('type')
-        self.logger.debug(f'[{ep_no}] Downloading {len(urls)} {type} using {self.concurrency} workers...')
+        # segments streamed to the muxer are not written to disk
+        if metadata.pop('write_to_disk', True):
+            self._start_disk_writer(ep_no)
+        # with auto concurrency, number of in-flight requests is adapted to the network conditions
+        controller = None
+        if self.concurrency is None:
+            controller = ConcurrencyController(self.min_concurrency, self.max_concurrency, name=ep_no)
+            self.logger.debug(f'[{ep_no}] Downloading {len(urls)} {type} using adaptive concurrency [{controller.min_limit}-{controller.max_limit}], starting at {controller.limit}...')
+        else:
+            self.logger.debug(f'[{ep_no}] Downloading {len(urls)} {type} using {self.concurrency} workers...')
 
         theme = PRINT_THEMES['results'] if DISPLAY_COLORS else ''
         metadata.update({
@@ -323,26 +749,153 @@ class BaseDownloader():
         # show progress of download using tqdm
         with tqdm(**metadata) as progress:
             # parallelize download of segments/chunks using a threadpool
-            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=self.thread_name_prefix) as executor:
-                results = [ executor.submit(download_func, ts_url) for ts_url in urls ]
+            executor = ThreadPoolExecutor(max_workers=controller.max_limit if controller else self.concurrency, thread_name_prefix=self.thread_name_prefix)
+            try:
+                # in-flight downloads mapped to (index of segment/chunk, attempt no, timing)
+                results = {}
+                # no. of in-flight requests per segment/chunk. More than one, if it is hedged.
+                in_flight = Counter()
+                completed = set()
+                hedged = set()
+                latencies = []
 
-                for result in as_completed(results):
-                    status, size = result.result()
-                    if 'ERROR' in status:
-                        self._colprint('error', status)
-                        failed_segments += 1
-                    elif 'Reusing' in status:
-                        reused_segments += 1
-                        # update status only if segment is downloaded
-                        progress.update(size)
+                def submit(idx, attempt, hedge=False):
+                    timing = {'hedge': hedge}
+                    future = executor.submit(self._run_with_budget, partial(self._timed_download, timing, download_func), urls[idx], controller)
+                    results[future] = (idx, attempt, timing)
+                    in_flight[idx] += 1
+
+                for idx in range(len(urls)):
+                    submit(idx, 1)
+                # failed segments/chunks waiting for their backoff to elapse: (retry at, sequence no, index of segment/chunk, attempt no)
+                retry_queue = []
+                # queued disk writes mapped to index of segment/chunk, and the downloaded segments/chunks waiting for them: [attempt no, size, pending writes, error]
+                writes = {}
+                writing = {}
+
+                # no. of segments/chunks neither completed nor failed
+                pending_count = len(urls)
+
+                def retry_or_fail(idx, attempt, e):
+                    nonlocal retried_segments, failed_segments, pending_count
+                    if in_flight[idx] > 0:
+                        # other request of the hedged segment/chunk is still running
+                        self.logger.debug(f'[{ep_no}] One of the hedged requests failed: {e}')
+                    elif isinstance(e, CircuitOpenError) and e.unavailable_for < self.circuit_max_wait:
+                        # host is paused by the circuit breaker. re-queue for when it is probed again, without using up an attempt.
+                        # once the host is down for too long, attempts are used up as well, so that the download fails in bounded time.
+                        self.logger.debug(f'[{ep_no}] {e}. Re-queuing {type} #{idx} after {e.retry_after:.2f}s')
+                        heapq.heappush(retry_queue, (time.monotonic() + e.retry_after, next(retry_seq), idx, attempt))
+                    elif attempt <= self.segment_retries:
+                        delay = self._get_retry_delay(attempt, e)
+                        self.logger.debug(f'[{ep_no}] Attempt {attempt} failed: {e}. Retrying in {delay:.2f}s')
+                        heapq.heappush(retry_queue, (time.monotonic() + delay, next(retry_seq), idx, attempt + 1))
+                        retried_segments += 1
                     else:
-                        progress.update(size)
+                        self._colprint('error', f'\nERROR: {e}')
+                        failed_segments += 1
+                        pending_count -= 1
+
+                while pending_count > 0:
+                    # re-submit the failed segments/chunks which are due for retry
+                    while retry_queue and retry_queue[0][0] <= time.monotonic():
+                        _, _, idx, attempt = heapq.heappop(retry_queue)
+                        submit(idx, attempt)
+
+                    # duplicate the straggling requests when workers are idle, and keep whichever completes first
+                    hedge_threshold = self._get_hedge_threshold(latencies)
+                    if hedge_threshold is not None and len(results) < (controller.limit if controller else self.concurrency):
+                        now = time.monotonic()
+                        for idx, attempt, timing in list(results.values()):
+                            if idx not in hedged and idx not in completed and now - timing.get('start', now) > hedge_threshold:
+                                self.logger.debug(f'[{ep_no}] Hedging request of {type} #{idx} running for {now - timing["start"]:.2f}s (threshold: {hedge_threshold:.2f}s)')
+                                hedged.add(idx)
+                                submit(idx, attempt, hedge=True)
+                                if len(results) >= (controller.limit if controller else self.concurrency): break
 
-                    # add reused / failed segments/chunks status
+                    timeout = max(0, retry_queue[0][0] - time.monotonic()) if retry_queue else None
+                    if hedge_threshold is not None:
+                        timeout = min(timeout, self.HEDGE_CHECK_INTERVAL) if timeout is not None else self.HEDGE_CHECK_INTERVAL
+                    if not results and not writes:
+                        # nothing in-flight. wait till the next retry is due.
+                        time.sleep(timeout)
+                        continue
+
+                    done, _ = wait([*results, *writes], timeout=timeout, return_when=FIRST_COMPLETED)
+                    for result in done:
+                        if result in writes:
+                            idx = writes.pop(result)
+                            state = writing[idx]
+                            state[2] -= 1
+                            if result.exception() and state[3] is None:
+                                state[3] = DownloadError(f'Failed to write {type} #{idx} to disk: {result.exception()}')
+                            if state[2] > 0:
+                                continue
+                            attempt, size, _, error = writing.pop(idx)
+                            if error is None:
+                                pending_count -= 1
+                            else:
+                                # downloaded data is lost. download the segment/chunk again.
+                                completed.discard(idx)
+                                progress.update(-size)
+                                retry_or_fail(idx, attempt, error)
+                            continue
+
+                        idx, attempt, timing = results.pop(result)
+                        in_flight[idx] -= 1
+                        if idx in completed:
+                            # the other request of a hedged segment/chunk has already completed it
+                            continue
+
+                        try:
+                            status, size = result.result()
+                        except Exception as e:
+                            retry_or_fail(idx, attempt, e)
+                        else:
+                            completed.add(idx)
+                            if in_flight[idx] > 0:
+                                # stop the losing request of the hedged segment/chunk
+                                for other_idx, _, other_timing in results.values():
+                                    if other_idx == idx: self._abort_request(other_timing)
+                            if timing.get('writes'):
+                                # segment/chunk is done once all its buffers are written by the disk writer
+                                writing[idx] = [attempt, size, len(timing['writes']), None]
+                                writes.update({ write: idx for write in timing['writes'] })
+                            else:
+                                pending_count -= 1
+                            if 'Reusing' in status:
+                                reused_segments += 1
+                            else:
+                                latencies.append(time.monotonic() - timing['start'])
+                            if timing['hedge']: hedged_segments += 1
+                            progress.update(size)
+
+                    # add reused / failed segments/chunks status, along with the ones waiting for retry
                     seg_status = f'R/F: {reused_segments}/{failed_segments}'
+                    if retry_queue: seg_status += f' | Retrying: {len(retry_queue)}'
+                    if self.disk_writer: seg_status += f' | WQ: {self.disk_writer.depth}'
                     progress.set_postfix_str(seg_status, refresh=True)
 
-        self.logger.info(f'[{ep_no}] {type.capitalize()} download status: Total: {len(urls)} | Reused: {reused_segments} | Failed: {failed_segments}')
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                if self.disk_writer:
+                    try:
+                        self.disk_writer.close()
+                    except Exception as e:
+                        self.logger.debug(f'[{ep_no}] {e}')
+                raise
+
+            # requests still running are the losing duplicates of hedged segments/chunks, which are already aborted.
+            # wait for them to stop, so that none of them writes to the temp/output directory once it is cleaned up.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+            # wait for the disk writer to write the queued segments/chunks
+            if self.disk_writer:
+                self.disk_writer.close()
+
+        self.logger.info(f'[{ep_no}] {type.capitalize()} download status: Total: {len(urls)} | Reused: {reused_segments} | Retries: {retried_segments} | Hedged: {len(hedged)} (won: {hedged_segments}) | Failed: {failed_segments}')
+        if controller:
+            self.logger.info(f'[{ep_no}] Adaptive concurrency: Final: {controller.limit} | Peak: {controller.peak_limit}')
         if failed_segments > 0:
             raise Exception(f'Failed to download {failed_segments} / {len(urls)} {type}')
 
@@ -353,62 +906,138 @@ class BaseDownloader():
             # iterate through the downloaded chunks
             for chunk_no in range(chunks_count):
                 chunk_file = os.path.join(f"{self.temp_dir}", f"{self.out_file}.chunk{chunk_no}")
-                # write the chunks to a single file
+                # append the chunks to a single file, copied within the kernel where possible
                 with open(chunk_file, 'rb') as s:
-                    outfile.write(s.read())
+                    self._copy_file_data(s, outfile)
                 # remove the merged chunk
                 os.remove(chunk_file)
 
-    def _download_subtitles(self):
-        for sub_name in list(self.subtitles):
-            sub_link = self.subtitles[sub_name]
-            sub_file = os.path.join(self.temp_dir, sub_name.replace(' ', '_') + '_' + os.path.basename(sub_link.split('?')[0]))
-            # update the dictionary pointing to downloaded file
-            self.subtitles[sub_name] = sub_file
+    def _download_to_single_file(self, dl_link, file_size):
+        '''
+        download chunks in parallel directly into a file preallocated to the download size.
+        Completed chunks are tracked in a bitmap sidecar file to resume the download.
+        '''
+        temp_out_file = os.path.join(f'{self.temp_dir}', f'{self.out_file}')
+        self.chunk_bitmap = ChunkBitmap(f'{temp_out_file}.bitmap', file_size, self.chunk_size)
 
-            try:
-                self.logger.debug(f'Downloading {sub_name} subtitle from {sub_link} to {sub_file}')
-                if os.path.isfile(sub_file):
-                    self.logger.debug('Subtitle file already exists. Skipping...')
-                    continue
-                sub_content = self._get_stream_data(sub_link)
-                # download the subtitle to local
-                with open(sub_file, 'wb') as f:
-                    f.write(sub_content)
+        self.out_fd = os.open(temp_out_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.out_fd_file = temp_out_file
+        self.out_fd_lock = threading.Lock()
+        try:
+            if os.fstat(self.out_fd).st_size != file_size:
+                self.logger.debug(f'Preallocating {file_size} bytes for {temp_out_file}')
+                os.ftruncate(self.out_fd, file_size)
+                try:
+                    # reserve the disk blocks upfront. Not supported on all platforms / file systems.
+                    os.posix_fallocate(self.out_fd, 0, file_size)
+                except (AttributeError, OSError):
+                    pass
 
-                if self.encrypted_subs_details.get(sub_name):
-                    self._decrypt_subtitle_file(sub_file, **self.encrypted_subs_details[sub_name])
+            chunk_urls = [ [dl_link, chunk_no, start, min(start + self.chunk_size, file_size) - 1] for chunk_no, start in enumerate(range(0, file_size, self.chunk_size)) ]
+            metadata = {
+                'type': 'chunks',
+                'total': file_size,
+                'unit': 'iB',
+                'unit_scale': True,
+                'unit_divisor': 1024
+            }
+            self._multi_threaded_download(self._download_chunk_at_offset, chunk_urls, **metadata)
 
+        finally:
+            os.close(self.out_fd)
+            self.chunk_bitmap.close()
+
+        # all chunks are downloaded. move the file to output directory.
+        self.chunk_bitmap.remove()
+        if not self._move_file(temp_out_file, os.path.join(f'{self.out_dir}', f'{self.out_file}')):
+            raise Exception(f'Failed to move {temp_out_file} to output directory')
+
+    def _start_subtitle_downloads(self):
+        '''
+        start downloading the subtitles in parallel, in the background. So that they are ready by the time the video is downloaded.
+        '''
+        if not self.subtitles or self.subtitle_futures is not None:
+            return
+
+        self.logger.debug(f'Downloading {len(self.subtitles)} subtitles in background')
+        executor = ThreadPoolExecutor(max_workers=max(1, min(len(self.subtitles), self.max_parallel_subtitles)), thread_name_prefix='udb-subs-')
+        # subtitles share the connection budget with the video
+        self.subtitle_futures = { sub_name: executor.submit(self._run_with_budget, self._download_subtitle, (sub_name, sub_link)) for sub_name, sub_link in self.subtitles.items() }
+        executor.shutdown(wait=False)
+
+    def _download_subtitles(self):
+        '''
+        wait for the subtitles to be downloaded (starting the downloads, if not already started) and point them to the downloaded files.
+        Subtitles which failed to download are dropped.
+        '''
+        self._start_subtitle_downloads()
+        for sub_name, future in (self.subtitle_futures or {}).items():
+            try:
+                # update the dictionary pointing to downloaded file
+                self.subtitles[sub_name] = future.result()
             except Exception as e:
                 self.logger.warning(f'Failed to download {sub_name} subtitle with error: {e}')
                 self.subtitles.pop(sub_name)
+        self.subtitle_futures = {}
 
-    def _decrypt_subtitle_file(self, sub_file, **kwargs):
-        self.logger.debug(f'Decrypting subtitle file: {sub_file}')
-        decrypter = kwargs['decrypter']
-        subs_key, subs_iv = kwargs['key'], kwargs['iv']
+    def _download_subtitle(self, sub_details):
+        '''
+        download the subtitle (decrypting it, if encrypted) and return the path of the downloaded file
+        '''
+        sub_name, sub_link = sub_details
+        sub_file = os.path.join(self.temp_dir, sub_name.replace(' ', '_') + '_' + os.path.basename(sub_link.split('?')[0]))
+        self.logger.debug(f'Downloading {sub_name} subtitle from {sub_link} to {sub_file}')
+        if os.path.isfile(sub_file):
+            self.logger.debug(f'Subtitle file of {sub_name} already exists. Skipping...')
+            return sub_file
 
-        with open(sub_file, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
+        sub_content = self._get_stream_data(sub_link)
+        # subtitle is decrypted in memory and written in a single pass, to a temp file and renamed. So that an encrypted/partial file is never reused.
+        part_file = f'{sub_file}.{threading.get_ident()}.part'
+        try:
+            if self.encrypted_subs_details.get(sub_name):
+                with open(part_file, 'w', encoding='utf-8') as f:
+                    f.write(self._decrypt_subtitle(sub_content, **self.encrypted_subs_details[sub_name]))
+            else:
+                with open(part_file, 'wb') as f:
+                    f.write(sub_content)
+            os.replace(part_file, sub_file)
+        finally:
+            if os.path.isfile(part_file): os.remove(part_file)
+
+        return sub_file
+
+    def _get_subtitle_decrypter(self, key, iv):
+        with self.subtitle_lock:
+            if (key, iv) not in self.subtitle_decrypters:
+                self.subtitle_decrypters[(key, iv)] = SubtitleDecrypter(key, iv)
+
+        return self.subtitle_decrypters[(key, iv)]
+
+    def _decrypt_subtitle(self, sub_content, **kwargs):
+        '''
+        decrypt the text lines of the subtitle (every line is AES-CBC encrypted & base64 encoded) in batches. Returns the decrypted subtitle text.
+        '''
+        decrypter = self._get_subtitle_decrypter(kwargs['key'], kwargs['iv'])
+        # read with universal newlines, same as a file opened in text mode
+        lines = io.StringIO(sub_content.decode('utf-8'), newline=None).readlines()
+
+        # sequence numbers, timestamps, and empty lines are retained as-is
+        text_indexes = [ i for i, line in enumerate(lines) if line.strip() and not line.strip().isdigit() and "-->" not in line ]
+        decrypted_lines = decrypter.decrypt_lines([ lines[i].strip() for i in text_indexes ])
 
         decryption_fail_count = 0
-        total_line_count = 0
-        with open(sub_file, 'w', encoding='utf-8') as file:
-            for line in lines:
-                if line.strip() and not line.strip().isdigit() and "-->" not in line:
-                    try:
-                        # decrypt and replace subtitle text lines
-                        file.write(decrypter(line.strip(), subs_key, subs_iv) + '\n')
-                        total_line_count += 1
-                    except:
-                        # write the line as-is if decryption fails
-                        file.write(line)
-                        decryption_fail_count += 1
-                else:
-                    # write sequence numbers, timestamps, and empty lines as-is
-                    file.write(line)
+        for i, decrypted_line in zip(text_indexes, decrypted_lines):
+            if decrypted_line is None:
+                # retain the line as-is if decryption fails
+                decryption_fail_count += 1
+            else:
+                lines[i] = decrypted_line + '\n'
+
         if decryption_fail_count > 0:
-            self.logger.warning(f'Failed to decrypt {decryption_fail_count}/{total_line_count} lines in the subtitle file')
+            self.logger.warning(f'Failed to decrypt {decryption_fail_count}/{len(text_indexes)} lines in the subtitle file')
+
+        return ''.join(lines)
 
     def _add_subtitles(self):
         # print(f'Converting {self.out_file} to mp4')
@@ -438,26 +1067,34 @@ class BaseDownloader():
         self.chunk_size = 1024*1024
         # create output directory
         self._create_out_dirs()
+        # subtitles are downloaded alongside the video
+        self._start_subtitle_downloads()
 
         self.logger.debug('Fetching stream data')
         dl_data = self._get_raw_stream_data(dl_link, True)
         file_size = int(dl_data.headers.get('content-length', 0))
+        dl_data.close()     # only headers are required
 
-        chunks = range(0, file_size, self.chunk_size)
-        chunk_urls = [[dl_link, self._create_chunk_header(chunk), f'{self.out_file}.chunk{chunk_no}'] for chunk_no, chunk in enumerate(chunks)] 
+        if self.preallocate and file_size > 0:
+            self.logger.debug('Downloading chunks into preallocated file')
+            self._download_to_single_file(dl_link, file_size)
 
-        self.logger.debug('Downloading chunks')
-        metadata = {
-            'type': 'chunks',
-            'total': file_size,
-            'unit': 'iB',
-            'unit_scale': True,
-            'unit_divisor': 1024
-        }
-        self._multi_threaded_download(self._download_chunk, chunk_urls, **metadata)
+        else:
+            chunks = range(0, file_size, self.chunk_size)
+            chunk_urls = [[dl_link, self._create_chunk_header(chunk), f'{self.out_file}.chunk{chunk_no}'] for chunk_no, chunk in enumerate(chunks)] 
+
+            self.logger.debug('Downloading chunks')
+            metadata = {
+                'type': 'chunks',
+                'total': file_size,
+                'unit': 'iB',
+                'unit_scale': True,
+                'unit_divisor': 1024
+            }
+            self._multi_threaded_download(self._download_chunk, chunk_urls, **metadata)
 
-        self.logger.debug('Merging chunks to single file')
-        self._merge_chunks(len(chunks))
+            self.logger.debug('Merging chunks to single file')
+            self._merge_chunks(len(chunks))
 
         if self.subtitles:
             self.logger.debug('Downloading subtitles')
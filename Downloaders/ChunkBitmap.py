@@ -0,0 +1,61 @@
+__author__ = 'Prudhvi PLN'
+
+import os
+import struct
+import threading
+
+
+class ChunkBitmap():
+    '''
+    Sidecar file tracking the completed chunks of a preallocated download, one bit per chunk.
+    - Header holds file size & chunk size, so that a sidecar of a different download is never reused
+    - Completing a chunk rewrites only the byte holding its bit
+    '''
+    HEADER = struct.Struct('>QQ')
+
+    def __init__(self, bitmap_file, file_size, chunk_size):
+        self.bitmap_file = bitmap_file
+        self.total_chunks = (file_size + chunk_size - 1) // chunk_size
+        self.header = self.HEADER.pack(file_size, chunk_size)
+        self.lock = threading.Lock()
+        self.bits = self._load()
+        self.fd = os.open(self.bitmap_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        os.write(self.fd, self.header + bytes(self.bits))
+        os.ftruncate(self.fd, self.HEADER.size + len(self.bits))
+
+    def _load(self):
+        '''
+        Load the bitmap from sidecar file if it belongs to the same download, else start afresh
+        '''
+        bitmap_size = (self.total_chunks + 7) // 8
+        if os.path.isfile(self.bitmap_file):
+            with open(self.bitmap_file, 'rb') as f:
+                data = f.read()
+            if data[:self.HEADER.size] == self.header and len(data) == self.HEADER.size + bitmap_size:
+                return bytearray(data[self.HEADER.size:])
+
+        return bytearray(bitmap_size)
+
+    def is_set(self, chunk_no):
+        return bool(self.bits[chunk_no >> 3] & (1 << (chunk_no & 7)))
+
+    def set(self, chunk_no):
+        '''
+        Mark the chunk as completed and persist it. Ignored if already completed (by the other request of a hedged chunk).
+        '''
+        with self.lock:
+            if self.is_set(chunk_no):
+                return
+            self.bits[chunk_no >> 3] |= 1 << (chunk_no & 7)
+            os.lseek(self.fd, self.HEADER.size + (chunk_no >> 3), os.SEEK_SET)
+            os.write(self.fd, bytes((self.bits[chunk_no >> 3],)))
+
+    def completed_count(self):
+        return sum(self.is_set(i) for i in range(self.total_chunks))
+
+    def close(self):
+        os.close(self.fd)
+
+    def remove(self):
+        if os.path.isfile(self.bitmap_file):
+            os.remove(self.bitmap_file)
@@ -0,0 +1,129 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from Utils.commons import DownloadSuperseded
+from Utils.HostHealthRegistry import CircuitOpenError
+
+
+class ConcurrencyController():
+    '''
+    Adaptive limit on the number of in-flight requests of a download, based on AIMD (additive increase, multiplicative decrease).
+    - Every window of `limit` completed requests, the throughput is compared with the previous window.
+      Limit is increased by 1 if throughput did not drop, else decreased by 1.
+    - On an error or throttling (HTTP 429), limit is halved. Only once per window, as a burst of failures is due to the same cause.
+    - Limit always stays within [min_limit, max_limit]
+    '''
+    def __init__(self, min_limit=2, max_limit=64, initial_limit=8, name=''):
+        self.logger = logging.getLogger()
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial_limit, self.min_limit), self.max_limit)
+        self.peak_limit = self.limit
+        self.name = name
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        # stats of current window
+        self.prev_throughput = None
+        self.decreased_in_window = False
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.window_size = 0
+        self.window_latency = 0
+        self.decreased_in_window = False
+
+    def _set_limit(self, new_limit, reason):
+        new_limit = min(max(new_limit, self.min_limit), self.max_limit)
+        if new_limit != self.limit:
+            self.logger.debug(f'[{self.name}] Concurrency changed from {self.limit} to {new_limit} ({reason})')
+            self.limit = new_limit
+            self.peak_limit = max(self.peak_limit, new_limit)
+            # wake up the waiting workers, if limit is increased
+            self.cond.notify_all()
+
+    def acquire(self):
+        '''
+        Wait till the number of in-flight requests is below the current limit
+        '''
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, size=0, error=False, throttled=False):
+        '''
+        Record the outcome of a completed request and adjust the limit
+
+        Args:
+        - latency: time taken by the request in seconds
+        - size: amount of data received (any unit, used only to compare throughput between windows)
+        - error: request failed
+        - throttled: request was rejected with HTTP 429
+        '''
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+            if error or throttled:
+                if not self.decreased_in_window:
+                    self._set_limit(self.limit // 2, 'throttled by server' if throttled else 'request failed')
+                    self.decreased_in_window = True
+                return
+
+            self.window_count += 1
+            self.window_size += size
+            self.window_latency += latency
+            if self.window_count < self.limit:
+                return
+
+            # end of window. compare throughput with previous window
+            elapsed = max(time.monotonic() - self.window_start, 1e-6)
+            throughput = self.window_size / elapsed
+            avg_latency = self.window_latency / self.window_count
+            if not self.decreased_in_window:
+                if self.prev_throughput is None or throughput >= self.prev_throughput * 0.95:
+                    self._set_limit(self.limit + 1, f'throughput: {throughput:.2f}/s, avg latency: {avg_latency:.2f}s')
+                else:
+                    self._set_limit(self.limit - 1, f'throughput dropped to {throughput:.2f}/s, avg latency: {avg_latency:.2f}s')
+            self.prev_throughput = throughput
+            self._reset_window()
+
+    def run(self, func, *args, slot=None):
+        '''
+        Run the request function within the concurrency limit. Function should return (status, size) tuple, or raise an exception on failure.
+        `slot` (ex: shared connection budget) is acquired once within the limit, and the time spent waiting for it is not counted as latency.
+        '''
+        self.acquire()
+        with slot if slot is not None else nullcontext():
+            start_time = time.monotonic()
+            try:
+                status, size = func(*args)
+            except (DownloadSuperseded, CircuitOpenError):
+                # duplicate request stopped midway, or request not sent as the host is down, so do not count it
+                self._discard()
+                raise
+            except Exception as e:
+                self.release(time.monotonic() - start_time, error=True, throttled=getattr(e, 'status', None) == 429)
+                raise
+
+            if 'Reusing' in status:
+                # nothing was downloaded, so do not count it
+                self._discard()
+            else:
+                self.release(time.monotonic() - start_time, size)
+
+        return status, size
+
+    def _discard(self):
+        '''
+        Release the slot without recording the request
+        '''
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
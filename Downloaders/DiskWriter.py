@@ -0,0 +1,116 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DiskWriter():
+    '''
+    Writes the downloaded segments/chunks to disk in dedicated writer threads, so that slow disks (like network shares) do not stall the network workers.
+    - Network workers hand over the completed buffers with `submit(write_func, *args)`. Queue is bounded, so workers wait once the writers fall behind.
+    - fsync policy: 'none' (left to the OS), 'file' (every file is synced once written), 'end' (all written files are synced on close)
+    - Outcome of every write is reported through the future returned by `submit()`, so that the segments/chunks failed to be written can be retried
+    '''
+    FSYNC_POLICIES = ('none', 'file', 'end')
+
+    def __init__(self, writers=1, queue_size=16, fsync='none', name=''):
+        self.logger = logging.getLogger()
+        self.name = name
+        self.fsync_policy = fsync if fsync in self.FSYNC_POLICIES else 'none'
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.threads = [ threading.Thread(target=self._run, name=f'udb-writer-{i}', daemon=True) for i in range(max(1, writers)) ]
+        self.failed = 0
+        self.unsynced_files = set()     # files to be synced on close, with 'end' policy
+        self.lock = threading.Lock()
+        self.closed = False
+        # stats for reporting
+        self.written = 0
+        self.peak_depth = 0
+        self.write_time = 0
+
+    @property
+    def depth(self):
+        '''
+        no. of buffers waiting to be written
+        '''
+        return self.queue.qsize()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while (item := self.queue.get()) is not None:
+            future, write_func, args = item
+            start = time.monotonic()
+            try:
+                write_func(*args)
+                with self.lock:
+                    self.written += 1
+                    self.write_time += time.monotonic() - start
+                future.set_result(None)
+            except Exception as e:
+                self.logger.debug(f'[{self.name}] Disk write failed with error: {e}')
+                with self.lock:
+                    self.failed += 1
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+    def submit(self, write_func, *args):
+        '''
+        Queue the write. Blocks if the queue is full, till the writers catch up. Returns future, which completes once the data is written.
+        '''
+        if self.closed:
+            # only the losing requests of hedged segments/chunks submit after the download is completed
+            raise Exception('Disk writer is closed')
+
+        future = Future()
+        self.queue.put((future, write_func, args))
+        depth = self.queue.qsize()
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+
+        return future
+
+    def fsync(self, fd, file):
+        '''
+        sync the written file as per the fsync policy. Called by the write functions, before marking the file as complete.
+        '''
+        if self.fsync_policy == 'file':
+            os.fsync(fd)
+        elif self.fsync_policy == 'end':
+            with self.lock:
+                self.unsynced_files.add(file)
+
+    def _sync_files(self):
+        for file in self.unsynced_files:
+            if not os.path.isfile(file):
+                continue
+            fd = os.open(file, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.unsynced_files.clear()
+
+    def close(self):
+        '''
+        Wait for the queued writes to complete and stop the writers
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.logger.info(f'[{self.name}] Disk writer status: Written: {self.written} | Failed: {self.failed} | Peak queue depth: {self.peak_depth} / {self.queue.maxsize} | Avg write time: {self.write_time / max(1, self.written):.3f}s')
+
+        self._sync_files()
@@ -0,0 +1,105 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import threading
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Downloaders.BaseDownloader import BaseDownloader
+from Downloaders.HLSDownloader import HLSDownloader
+from Downloaders.MemoryBudget import MemoryBudget
+from Utils.BandwidthLimiter import BandwidthLimiter
+
+
+class DownloadScheduler():
+    '''
+    Schedules episode downloads across a bounded pool of workers.
+    - Runs up to `max_parallel_downloads` episodes at the same time
+    - Shares a global connection budget (`max_total_connections`) across all the running episodes
+    - Shares a global memory budget (`memory_budget_mb`) for the data held in memory by all the running episodes
+    - Bandwidth limits are shared by all the running episodes as well (see BandwidthLimiter)
+    '''
+    def __init__(self, dl_config):
+        self.logger = logging.getLogger()
+        self.max_parallel_downloads = max(1, int(dl_config.get('max_parallel_downloads', 1) or 1))
+        self.max_total_connections = self._get_connection_budget_size(dl_config)
+        # every downloader acquires a slot from this budget before opening a connection
+        self.connection_budget = threading.BoundedSemaphore(self.max_total_connections)
+        # bytes held in memory by the downloaders are capped by this budget, if set
+        memory_budget_mb = dl_config.get('memory_budget_mb', 0) or 0
+        self.memory_budget = MemoryBudget(int(memory_budget_mb * 1024 * 1024)) if memory_budget_mb > 0 else None
+        # limits can be reloaded with a signal, which can be registered only from the main thread
+        BandwidthLimiter.get_limiter().register_signal()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_parallel_downloads, thread_name_prefix='udb-sched-')
+        self.futures = {}
+        self.logger.debug(f'Download scheduler initialized with {self.max_parallel_downloads} parallel downloads and {self.max_total_connections} total connections')
+
+    def _get_connection_budget_size(self, dl_config):
+        '''
+        Returns the global connection budget. If set to auto, allow as many connections as a single file download can use
+        (the max of adaptive concurrency, if concurrency per file is auto)
+        '''
+        max_total_connections = dl_config.get('max_total_connections', 'auto')
+        if max_total_connections in (None, 'auto'):
+            concurrency = dl_config.get('concurrency_per_file', 'auto')
+            max_total_connections = dl_config.get('max_concurrency_per_file', 64) if concurrency == 'auto' else concurrency
+
+        return max(1, int(max_total_connections))
+
+    def _get_downloader(self, dl_config, ep_details):
+        '''
+        Returns the downloader instance based on the download type of the episode
+        '''
+        downloader_class = HLSDownloader if ep_details['downloadType'] == 'hls' else BaseDownloader
+        # downloaders do not open more connections than the budget, even if their concurrency is higher
+        dl_config = {**dl_config, 'max_total_connections': self.max_total_connections}
+        return downloader_class(dl_config, ep_details, connection_budget=self.connection_budget, memory_budget=self.memory_budget)
+
+    def _download(self, dl_config, ep_details):
+        downloader = self._get_downloader(dl_config, ep_details)
+        return downloader.start_download(ep_details['downloadLink'])
+
+    def submit(self, dl_config, ep_details):
+        '''
+        Queue an episode for download. Download starts as soon as a worker is available.
+        '''
+        self.logger.debug(f'Scheduling download for {ep_details["episodeName"]}')
+        # downloader gets its own copy, as the details (like subtitles) are modified during the download, while the client may still be using them
+        future = self.executor.submit(self._download, dl_config, deepcopy(ep_details))
+        self.futures[future] = ep_details['episodeName']
+
+        return future
+
+    def cancel(self):
+        '''
+        Cancel the pending downloads. Running downloads are allowed to wind up.
+        '''
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait(self):
+        '''
+        Wait for all scheduled downloads to complete.
+
+        Returns: dict of episode name and error message (None if downloaded successfully)
+        '''
+        results = {}
+        try:
+            for future in as_completed(self.futures):
+                ep_name = self.futures[future]
+                try:
+                    future.result()
+                    results[ep_name] = None
+                    self.logger.info(f'Download completed for {ep_name}')
+                except Exception as e:
+                    results[ep_name] = f'{e}'
+                    self.logger.error(f'Download failed for {ep_name} with error: {e}')
+
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+
+        self.executor.shutdown(wait=True)
+        if self.memory_budget:
+            self.logger.debug(f'Peak memory held by downloads: {self.memory_budget.peak} / {self.memory_budget.limit} bytes')
+
+        return results
@@ -1,11 +1,17 @@
 __author__ = 'Prudhvi PLN'
 
 import os
-import re
-import shutil
+import threading
+import zlib
+from contextlib import nullcontext
+from urllib.parse import urlsplit
 
-from Utils.commons import retry
-from Utils.BaseDownloader import BaseDownloader
+from Utils.commons import retry, DownloadError, DownloadSuperseded
+from Utils.HostHealthRegistry import CircuitOpenError
+from Utils.M3u8Parser import M3u8Parser
+from Downloaders.BaseDownloader import BaseDownloader
+from Downloaders.HlsDecrypter import HlsDecrypter
+from Downloaders.StreamMuxer import StreamMuxer
 
 
 class HLSDownloader(BaseDownloader):
@@ -13,84 +19,279 @@ class HLSDownloader(BaseDownloader):
     # References: https://github.com/Oshan96/monkey-dl/blob/master/anime_downloader/util/hls_downloader.py
     # https://github.com/josephcappadona/m3u8downloader/blob/master/m3u8downloader/m3u8.py
 
-    def __init__(self, dl_config, ep_details, session=None):
+    def __init__(self, dl_config, ep_details, session=None, connection_budget=None, memory_budget=None):
         # initialize base downloader
-        super().__init__(dl_config, ep_details, session)
+        super().__init__(dl_config, ep_details, session, connection_budget, memory_budget)
         # initialize HLS specific configuration
         self.m3u8_file = os.path.join(f'{self.temp_dir}', 'uwu.m3u8')
         self.thread_name_prefix = 'udb-hls-'
+        # stream segments directly into ffmpeg instead of writing every segment to temp directory
+        self.stream_mux = dl_config.get('hls_stream_mux', False)
+        # max out-of-order segments held in memory while stream muxing. Rest are spilled to temp directory.
+        self.stream_mux_window = dl_config.get('hls_stream_mux_window', 32)
+        self.muxer = None
+        # decrypt AES-128 encrypted segments as they are downloaded, instead of leaving it to ffmpeg
+        self.inprocess_decryption = dl_config.get('hls_inprocess_decryption', True)
+        self.decrypter = None
+        # adjacent byte ranges of the same url are downloaded in a single request, upto this size
+        self.coalesce_size = dl_config.get('hls_coalesce_size_mb', 4) * 1024 * 1024
+        # local file name of every segment, by (url, byte range)
+        self.segment_files = {}
+
+    def _has_uri(self, playlist):
+        # segments are encrypted (and not decrypted in-process), or have an initialization section (map)
+        return (playlist.is_encrypted and self.decrypter is None) or len(playlist.maps) > 0
+
+    def _get_file_nm(self, prefix, index, url, default_ext):
+        # file names are based on the index, as byte range segments share the same url & different urls can have the same file name
+        ext = os.path.splitext(urlsplit(url).path)[1] or default_ext
+        return f'{prefix}{index:05d}{ext}'
+
+    def _get_key_file_nm(self, index, key):
+        return self._get_file_nm('key', index, key.uri, '.key')
+
+    def _get_map_file_nm(self, index, init_map):
+        return self._get_file_nm('init', index, init_map.uri, '.mp4')
+
+    def _collect_uri_iv(self, playlist):
+        '''
+        Returns download units (see `_collect_ts_urls`) of all the keys (unless decrypted in-process) & maps used by the segments
+        '''
+        units = []
+        if self.decrypter is None:
+            units.extend( (key.uri, None, ((self._get_key_file_nm(i, key), None, None),)) for i, key in enumerate(playlist.keys) if key.method != 'NONE' and key.uri )
+        for i, init_map in enumerate(playlist.maps):
+            # byte range of map is (length, offset). Range of download unit is (offset, length).
+            byte_range = (init_map.byte_range[1], init_map.byte_range[0]) if init_map.byte_range else None
+            # map is passed in place of the segment, so that it is decrypted in-process along with the segments, if encrypted
+            units.append((init_map.uri, byte_range, ((self._get_map_file_nm(i, init_map), None, init_map),)))
+
+        return units
+
+    def _collect_ts_urls(self, playlist):
+        '''
+        Returns list of download units as (url, byte range as (offset, length) or None, parts).
+        - parts: (file name, length, segment) of the segments in the unit, which are saved as separate files
+        - adjacent byte ranges of the same url are coalesced into a single unit, upto the coalesce size
+        '''
+        units = []
+        self.segment_files = {}
+        for index, segment in enumerate(playlist.segments):
+            # Some m3u8 files have duplicate segments, so download them only once
+            segment_id = (segment.uri, segment.byte_range)
+            if segment_id in self.segment_files:
+                continue
+            file_nm = self._get_file_nm('', index, segment.uri, '.ts')
+            self.segment_files[segment_id] = file_nm
+
+            if segment.byte_range is None:
+                units.append((segment.uri, None, ((file_nm, None, segment),)))
+                continue
+
+            length, offset = segment.byte_range
+            if units and units[-1][0] == segment.uri and units[-1][1] is not None:
+                last_offset, last_length = units[-1][1]
+                if last_offset + last_length == offset and last_length + length <= self.coalesce_size:
+                    units[-1] = (segment.uri, (last_offset, last_length + length), units[-1][2] + ((file_nm, length, segment),))
+                    continue
+            units.append((segment.uri, (offset, length), ((file_nm, length, segment),)))
+
+        self.logger.debug(f'Collected {len(self.segment_files)} segments into {len(units)} download units')
+        return units
+
+    def _get_cipher(self, segment):
+        # cipher to decrypt the segment (or map), if it is encrypted & decrypted in-process
+        return self.decrypter.get_cipher(segment) if self.decrypter and segment else None
+
+    def _get_item_url(self, item):
+        # segments streamed to the muxer are passed along with their index
+        return item[1][0] if isinstance(item[0], int) else item[0]
+
+    def _get_unit_response(self, unit):
+        '''
+        request the data of a download unit, using Range header for byte ranges
+        '''
+        ts_url, byte_range, _ = unit
+        if byte_range is None:
+            return self._get_raw_stream_data(ts_url)
 
-    def _has_uri(self, m3u8_data):
-        method = re.search('URI=(.*)', m3u8_data)
-        if method is None: return False
-        if method.group(1) == "NONE": return False
+        offset, length = byte_range
+        response = self._get_raw_stream_data(ts_url, header={'Range': f'bytes={offset}-{offset + length - 1}'})
+        status = response.status if self.use_http_client else response.status_code
+        # server ignored the range and sent the whole file. usable only if range starts at the beginning.
+        if status == 200 and offset > 0:
+            response.close()
+            raise DownloadError(f'Range requests are not supported by the server for {ts_url}')
 
-        return True
+        return response
+
+    def _get_part_reader(self, blocks):
+        '''
+        Returns a function to iterate over the next `length` bytes (or all remaining bytes, if None) of the response blocks.
+        Used to split the response of a unit into its segments.
+        '''
+        leftover = b''
+        def read_part(length):
+            nonlocal leftover
+            remaining = length
+            while remaining is None or remaining > 0:
+                if leftover:
+                    data, leftover = leftover, b''
+                else:
+                    data = next(blocks, b'')
+                if not data:
+                    break
+                if remaining is not None:
+                    data, leftover = data[:remaining], data[remaining:]
+                    remaining -= len(data)
+                yield data
+            if remaining:
+                raise Exception(f'Response ended {remaining} bytes before the end of segment')
+
+        return read_part
+
+    def _download_segment(self, unit):
+        '''
+        download segment file (or coalesced segments) from url. Every segment is saved as a separate file. Reuse if already downloaded.
 
-    def _collect_uri_iv(self, m3u8_data):
-        # Case-1: typical HLS using URI & IV
-        uri_iv = re.search('#EXT-X-KEY:METHOD=AES-128,URI="(.*)",IV=(.*)', m3u8_data)
+        Returns: (download_status, progress_bar_increment). Raises DownloadError on failure.
+        '''
+        _, _, parts = unit
+        unit_nm = parts[0][0] if len(parts) == 1 else f'{parts[0][0]} - {parts[-1][0]}'
+        # segments of the unit are recorded in order, so unit is complete once its last segment is recorded
+        last_file_nm = parts[-1][0]
+        # temp file is unique per request, as a hedged request may be downloading the same segment
+        part_file = os.path.join(f"{self.temp_dir}", f"{last_file_nm}.{threading.get_ident()}.part")
+        try:
+            # check if the segments are already downloaded
+            if all( self.journal.is_complete(file_nm, os.path.join(f"{self.temp_dir}", f"{file_nm}")) for file_nm, _, _ in parts ):
+                return (f'Segment file [{unit_nm}] already exists. Reusing.', len(parts))
 
-        # Case-2: typical HLS using URI only
-        if uri_iv is None:
-            uri_data = re.search('URI="(.*)"', m3u8_data)
-            return uri_data.group(1), None
+            # with disk writer, the buffer of every segment is held from the memory budget instead, till it is written
+            with (nullcontext() if self.disk_writer else self._reserve_memory(self.write_block_size)):
+                self._write_unit_parts(unit, unit_nm, last_file_nm, part_file)
 
-        uri = uri_iv.group(1)
-        iv = uri_iv.group(2)
+            return (f'Segment file [{unit_nm}] downloaded', len(parts))
 
-        return uri, iv
+        except (DownloadSuperseded, CircuitOpenError):
+            raise
 
-    def _collect_ts_urls(self, m3u8_link, m3u8_data):
-        # Improved regex to handle all cases. (get all lines except those starting with #)
-        base_url = '/'.join(m3u8_link.split('/')[:-1])
-        normalize_url = lambda url, base_url: (url if url.startswith('http') else 'https:' + url if url.startswith('//') else base_url + '/' + url)
-        # Some m3u8 files have duplicate urls, so using set to remove duplicates
-        urls = list(set( normalize_url(url.group(0), base_url) for url in re.finditer("^(?!#).+$", m3u8_data, re.MULTILINE) ))
+        except Exception as e:
+            raise DownloadError(f'Segment download failed [{unit_nm}] due to: {e}', getattr(e, 'status', None), getattr(e, 'retry_after', None))
 
-        return urls
+        finally:
+            if os.path.isfile(part_file): os.remove(part_file)
 
-    @retry()
-    def _download_segment(self, ts_url):
+    def _write_unit_parts(self, unit, unit_nm, last_file_nm, part_file):
         '''
-        download segment file from url. Reuse if already downloaded.
-
-        Returns: (download_status, progress_bar_increment)
+        stream the response of the unit to disk, block by block, writing every segment to its own file
         '''
+        _, _, parts = unit
+        response = self._get_unit_response(unit)
         try:
-            segment_file_nm = ts_url.split('/')[-1]
-            segment_file = os.path.join(f"{self.temp_dir}", f"{segment_file_nm}")
-
-            # check if the segment is already downloaded
-            if os.path.isfile(segment_file) and os.path.getsize(segment_file) > 0:
-                return (f'Segment file [{segment_file_nm}] already exists. Reusing.', 1)
-
-            with open(segment_file, "wb") as ts_file:
-                ts_file.write(self._get_stream_data(ts_url))
+            read_part = self._get_part_reader(iter(self._iter_stream_data(response, self.write_block_size)))
+            for file_nm, length, segment in parts:
+                cipher = self._get_cipher(segment)
+                if self.disk_writer:
+                    # hand over the segment to the disk writer, so that this worker moves on to the next segment
+                    data = bytearray()
+                    for block in read_part(length):
+                        # stop if the other request of a hedged segment has completed it
+                        if self.journal.is_complete(last_file_nm):
+                            raise DownloadSuperseded(f'Segment [{unit_nm}] downloaded by hedged request')
+                        data += cipher.update(block) if cipher else block
+                    if cipher: data += cipher.finalize()
+                    self._submit_write(data, self._save_file, file_nm, data, os.path.join(f"{self.temp_dir}", f"{file_nm}"))
+                    continue
+
+                # write to a temp file and rename, so that partial segment is never reused
+                size, crc = 0, 0
+                with open(part_file, "wb") as ts_file:
+                    for data in read_part(length):
+                        # stop if the other request of a hedged segment has completed it
+                        if self.journal.is_complete(last_file_nm):
+                            raise DownloadSuperseded(f'Segment [{unit_nm}] downloaded by hedged request')
+                        if cipher: data = cipher.update(data)
+                        size += ts_file.write(data)
+                        crc = zlib.crc32(data, crc)
+                    if cipher:
+                        data = cipher.finalize()
+                        size += ts_file.write(data)
+                        crc = zlib.crc32(data, crc)
+                os.replace(part_file, os.path.join(f"{self.temp_dir}", f"{file_nm}"))
+                self.journal.record(file_nm, size, crc)
+        finally:
+            response.close()
+
+    def _download_segment_to_muxer(self, indexed_unit):
+        '''
+        download segment (or coalesced segments) from url and hand it over to the stream muxer
 
-            return (f'Segment file [{segment_file_nm}] downloaded', 1)
+        Returns: (download_status, progress_bar_increment). Raises DownloadError on failure.
+        '''
+        index, unit = indexed_unit
+        _, _, parts = unit
+        unit_nm = parts[0][0] if len(parts) == 1 else f'{parts[0][0]} - {parts[-1][0]}'
+        # temp file is unique per request, as a hedged request may be downloading the same segment
+        spill_file = os.path.join(f"{self.temp_dir}", f"spill_{index}.{threading.get_ident()}.part")
+        reserved = 0
+        try:
+            response = self._get_unit_response(unit)
+            # hold the segment in memory if the memory budget allows, else stream it to a file which the muxer reads when it is its turn
+            size = int(response.headers.get('Content-Length') or self.write_block_size)
+            in_memory = self.memory_budget is None or self.memory_budget.try_acquire(size)
+            if self.memory_budget and in_memory: reserved = size
+            data = bytearray()
+            with (nullcontext() if in_memory else open(spill_file, 'wb')) as spill:
+                write = spill.write if spill else data.extend
+                read_part = self._get_part_reader(iter(self._iter_stream_data(response, self.write_block_size)))
+                for _, length, segment in parts:
+                    cipher = self._get_cipher(segment)
+                    for block in read_part(length):
+                        # stop if the other request of a hedged segment has completed it
+                        if self.muxer.is_done(index):
+                            response.close()
+                            raise DownloadSuperseded(f'Segment [{unit_nm}] downloaded by hedged request')
+                        write(cipher.update(block) if cipher else block)
+                    if cipher: write(cipher.finalize())
+            response.close()
+
+            if in_memory:
+                # muxer takes over the reserved memory
+                reserved, held = 0, reserved
+                self.muxer.add(index, data, held)
+            else:
+                self.muxer.add_file(index, spill_file)
+
+            return (f'Segment [{unit_nm}] streamed', len(parts))
+
+        except (DownloadSuperseded, CircuitOpenError):
+            raise
 
         except Exception as e:
-            return (f'\nERROR: Segment download failed [{segment_file_nm}] due to: {e}', 0)
+            raise DownloadError(f'Segment download failed [{unit_nm}] due to: {e}', getattr(e, 'status', None), getattr(e, 'retry_after', None))
 
-    def _rewrite_m3u8_file(self, m3u8_data):
-        # regex safe temp dir path
-        seg_temp_dir = self.temp_dir.replace('\\', '\\\\')
+        finally:
+            if reserved: self.memory_budget.release(reserved)
+            if os.path.isfile(spill_file): os.remove(spill_file)
+
+    def _rewrite_m3u8_file(self, playlist):
         # ffmpeg doesn't accept backward slash in key file irrespective of platform
         key_temp_dir = self.temp_dir.replace('\\', '/')
+        # point the segments, keys & maps to the downloaded files
+        m3u8_content = playlist.dumps(lambda segment: os.path.join(self.temp_dir, self.segment_files[(segment.uri, segment.byte_range)]),
+                                      key_path=lambda key: f'{key_temp_dir}/{self._get_key_file_nm(playlist.keys.index(key), key)}',
+                                      map_path=lambda init_map: f'{key_temp_dir}/{self._get_map_file_nm(playlist.maps.index(init_map), init_map)}',
+                                      include_keys=self.decrypter is None)
         with open(self.m3u8_file, 'w', encoding='utf-8') as m3u8_f:
-            m3u8_content = re.sub('URI=(.*)/', f'URI="{key_temp_dir}/', m3u8_data, count=1)
-            regex_safe = '\\\\' if os.sep == '\\' else '/'
-            # strip off url for segments
-            m3u8_content = re.sub(r'(.*)//(.*)/', '', m3u8_content)
-            # prefix the downloaded path for segments
-            m3u8_content = re.sub(r'^(?!#).+$', rf'{seg_temp_dir}{regex_safe}\g<0>', m3u8_content, flags=re.MULTILINE)
             m3u8_f.write(m3u8_content)
 
-    def _convert_to_mp4(self):
-        # print(f'Converting {self.out_file} to mp4')
+    def _get_mux_cmd(self, input_args):
+        '''
+        Returns the ffmpeg command to create mp4 from the given input along with subtitles
+        '''
         out_file = os.path.join(f'{self.out_dir}', f'{self.out_file}')
-        command = [f'ffmpeg -loglevel warning -allowed_extensions ALL -i "{self.m3u8_file}"']
+        command = [f'ffmpeg -loglevel warning {input_args}']
         maps = ['-map 0:v -map 0:a'] if self.subtitles else []
         metadata = []
 
@@ -102,190 +303,97 @@ class HLSDownloader(BaseDownloader):
 
         metadata.append(f'-c:v copy -c:a copy -c:s mov_text -bsf:a aac_adtstoasc "{out_file}"')
 
-        cmd = ' '.join(command + maps + metadata)
+        return ' '.join(command + maps + metadata)
+
+    def _convert_to_mp4(self):
+        # print(f'Converting {self.out_file} to mp4')
+        cmd = self._get_mux_cmd(f'-allowed_extensions ALL -i "{self.m3u8_file}"')
         self._exec_cmd(cmd)
-    
-    def _move_file(self, src, dest):
-        """Helper method to move files with proper error handling"""
-        try:
-            shutil.copy2(src, dest)
-            self.logger.debug(f"Moved file from {src} to {dest}")
-            return True
-        except Exception as e:
-            self.logger.warning(f"Failed to move file from {src} to {dest}: {e}")
-            return False
-
-    def _remove_out_dirs(self):
-        """Process subtitle files, move them to output directory, and clean up temp directory"""
-        # Extract the base episode name without extension
-        episode_base_name = os.path.splitext(self.out_file)[0]
-    
-        # Make sure output directory exists
-        os.makedirs(self.out_dir, exist_ok=True)
-    
-        # Keep track of processed files to ensure we don't delete needed files
-        processed_files = []
-    
-        # Language code mapping (add more as needed)
-        language_mappings = {
-            'arabic': 'ar',
-            'english': 'en',
-            'hindi': 'hi',
-            'indonesia': 'id',
-            'khmer': 'km',
-            'malay': 'ms',
-            'spanish': 'es',
-            'french': 'fr',
-            'german': 'de',
-            'italian': 'it',
-            'japanese': 'ja',
-            'korean': 'ko',
-            'chinese': 'zh',
-            'russian': 'ru',
-            'vietnamese': 'vi',
-            'thai': 'th',
-            'portuguese': 'pt',
-            'turkish': 'tr',
-        }
-    
-        # Process subtitle files first - rename and move to output directory
-        subtitle_count = 0
-        for root, dirs, files in os.walk(self.temp_dir):
-            for file in files:
-                if file.endswith('.srt'):
-                    try:
-                        # Get original file path
-                        original_path = os.path.join(root, file)
-                    
-                        # Determine language code from filename
-                        lang_code = None
-                        file_lower = file.lower()
-                    
-                        # First, try to find from standard language codes in filename
-                        lang_code_match = re.search(r'\.([a-z]{2})\.srt$', file_lower)
-                        if lang_code_match:
-                            lang_code = lang_code_match.group(1)
-                        else:
-                            # Try to find from file prefix
-                            file_prefix = file_lower.split('_')[0]
-                            if file_prefix in language_mappings:
-                                lang_code = language_mappings[file_prefix]
-                            # Check for language names in the filename
-                            else:
-                                for lang_name, code in language_mappings.items():
-                                    if lang_name.lower() in file_lower:
-                                        lang_code = code
-                                        break
-                    
-                        # Default to English if language can't be determined
-                        if not lang_code:
-                            self.logger.debug(f"Could not determine language code for {file}, defaulting to English")
-                            lang_code = 'en'
-                    
-                        # Create new filename with episode name and language code
-                        new_filename = f"{episode_base_name}.{lang_code}.srt"
-                        new_path = os.path.join(self.out_dir, new_filename)
-                    
-                        # Move and rename file using our helper method
-                        self._move_file(original_path, new_path)
-                        processed_files.append(original_path)
-                        subtitle_count += 1
-                        self.logger.debug(f"Processed subtitle: {file} → {new_filename}")
-                    
-                    except Exception as e:
-                        self.logger.warning(f"Failed to process subtitle file {file}: {e}")
-    
-        # Also ensure video file is in output directory if it exists in temp
-        mp4_files = [f for f in os.listdir(self.temp_dir) if f.endswith('.mp4')]
-        for mp4_file in mp4_files:
-            try:
-                src_path = os.path.join(self.temp_dir, mp4_file)
-                dest_path = os.path.join(self.out_dir, mp4_file)
-                if os.path.exists(src_path) and not os.path.exists(dest_path):
-                    self._move_file(src_path, dest_path)
-                    processed_files.append(src_path)
-                    self.logger.debug(f"Moved video file: {mp4_file} to {self.out_dir}")
-            except Exception as e:
-                self.logger.warning(f"Failed to move video file {mp4_file}: {e}")
-    
-        self.logger.debug(f"Processed {subtitle_count} subtitle files")
-    
-        # Now clean up temp directory - remove processed files first
-        for file_path in processed_files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                self.logger.warning(f"Failed to remove processed file {file_path}: {e}")
-    
-        # Remove any remaining files in temp_dir
-        try:
-            for item in os.listdir(self.temp_dir):
-                item_path = os.path.join(self.temp_dir, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-                else:
-                    os.remove(item_path)
-        except Exception as e:
-            self.logger.warning(f"Error cleaning remaining files in temp dir: {e}")
-    
-        # Now remove the temp directory itself
-        try:
-            if os.path.exists(self.temp_dir):
-                os.rmdir(self.temp_dir)
-                self.logger.debug("Removed temp_dir after moving files.")
-        except Exception as e:
-            self.logger.warning(f"Failed to remove temp_dir: {e}")
-    
-        # Check if parent temp dir is empty and remove if it is
+
+    def _stream_to_mp4(self, units):
+        '''
+        Download the segments and mux them into mp4 on the fly, without writing the segments to temp directory
+        '''
+        # ffmpeg can't overwrite the file without prompting. So, remove any partial file from previous runs
+        out_file = os.path.join(f'{self.out_dir}', f'{self.out_file}')
+        if os.path.isfile(out_file): os.remove(out_file)
+
+        self.muxer = StreamMuxer(self._get_mux_cmd('-f mpegts -i pipe:0'), len(units), self.temp_dir, self.stream_mux_window, self.memory_budget, self.write_block_size)
+        self.muxer.start()
         try:
-            if os.path.exists(self.parent_temp_dir) and len(os.listdir(self.parent_temp_dir)) == 0:
-                os.rmdir(self.parent_temp_dir)
-                self.logger.debug("Removed parent temp_dir (empty).")
-        except Exception as e:
-            self.logger.warning(f"Failed to remove parent temp_dir: {e}")
+            metadata = {
+                'type': 'segments',
+                'total': sum( len(parts) for _, _, parts in units ),
+                'unit': 'seg',
+                'write_to_disk': False
+            }
+            self._multi_threaded_download(self._download_segment_to_muxer, list(enumerate(units)), **metadata)
+            self.muxer.close()
+        except Exception:
+            self.muxer.abort()
+            if os.path.isfile(out_file): os.remove(out_file)
+            raise
 
     def start_download(self, m3u8_link):
         # create output directory
         self._create_out_dirs()
+        # subtitles are downloaded alongside the segments
+        self._start_subtitle_downloads()
 
-        iv = None
         self.logger.debug('Fetching stream data')
         m3u8_data = self._get_stream_data(m3u8_link, True)
+        playlist = M3u8Parser.parse(m3u8_data, m3u8_link)
 
-        self.logger.debug('Check if stream is encrypted/mapped')
-        if self._has_uri(m3u8_data):
-            self.logger.debug('Stream is encrypted/mapped. Collect iv data and download key')
-            key_uri, iv = self._collect_uri_iv(m3u8_data)
-            status = self._download_segment(key_uri)
-            if status[1] == 0: self.logger.error(f'Failed to download key/map file with error: {status[0]}')
+        if playlist.is_encrypted and self.inprocess_decryption and HlsDecrypter.is_supported(playlist):
+            self.logger.debug('Stream is encrypted. Segments are decrypted as they are downloaded')
+            # keys are few requests before the segments, so a blocking retry is fine here
+            self.decrypter = HlsDecrypter(playlist, retry(exceptions=(DownloadError,))(self._get_stream_data))
+            self.decrypter.prefetch_keys()
 
-        # did not run into HLS with IV during development, so skipping it
-        if iv:
-            raise Exception("Current code cannot decode IV links")
+        self.logger.debug('Check if stream is encrypted/mapped')
+        if self._has_uri(playlist):
+            self.logger.debug('Stream is encrypted/mapped. Download keys/maps')
+            for unit in self._collect_uri_iv(playlist):
+                try:
+                    # keys/maps are few requests before the segments, so a blocking retry is fine here
+                    retry(exceptions=(DownloadError, CircuitOpenError))(self._download_segment)(unit)
+                except (DownloadError, CircuitOpenError) as e:
+                    self.logger.error(f'Failed to download key/map file with error: {e}')
 
         self.logger.debug('Collect m3u8 segment urls')
-        ts_urls = self._collect_ts_urls(m3u8_link, m3u8_data)
-
-        self.logger.debug('Downloading collected segments')
-        metadata = {
-            'type': 'segments',
-            'total': len(ts_urls),
-            'unit': 'seg'
-        }
-        self._multi_threaded_download(self._download_segment, ts_urls, **metadata)
-
-        self.logger.debug('Rewrite m3u8 file with downloaded segments paths')
-        self._rewrite_m3u8_file(m3u8_data)
-
-        if self.subtitles:
-            self.logger.debug('Downloading subtitles')
-            self._download_subtitles()
-
-        self.logger.debug('Converting m3u8 segments to .mp4')
-        self.logger.debug('Starting mp4 conversion')
-        self._convert_to_mp4()
-        self.logger.debug('Completed mp4 conversion')
+        units = self._collect_ts_urls(playlist)
+
+        # encrypted (unless decrypted in-process)/mapped streams are processed by ffmpeg using the local playlist, so stream muxing is not possible for them
+        if self.stream_mux and not self._has_uri(playlist):
+            # subtitles are required before starting ffmpeg, as all the inputs are opened upfront
+            if self.subtitles:
+                self.logger.debug('Downloading subtitles')
+                self._download_subtitles()
+
+            self.logger.debug('Streaming collected segments to mp4')
+            self._stream_to_mp4(units)
+            self.logger.debug('Completed mp4 conversion')
+
+        else:
+            self.logger.debug('Downloading collected segments')
+            metadata = {
+                'type': 'segments',
+                'total': sum( len(parts) for _, _, parts in units ),
+                'unit': 'seg'
+            }
+            self._multi_threaded_download(self._download_segment, units, **metadata)
+
+            self.logger.debug('Rewrite m3u8 file with downloaded segments paths')
+            self._rewrite_m3u8_file(playlist)
+
+            if self.subtitles:
+                self.logger.debug('Downloading subtitles')
+                self._download_subtitles()
+
+            self.logger.debug('Converting m3u8 segments to .mp4')
+            self.logger.debug('Starting mp4 conversion')
+            self._convert_to_mp4()
+            self.logger.debug('Completed mp4 conversion')
 
         # Remove temp dir once completed
         self.logger.debug('Removing temporary directories')
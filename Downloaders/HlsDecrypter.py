@@ -0,0 +1,104 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import threading
+from Cryptodome.Cipher import AES
+
+
+class SegmentCipher():
+    '''
+    Decrypts an AES-128-CBC encrypted segment block by block, as it is downloaded.
+    Last block is held back till `finalize()`, as it has the PKCS7 padding to be removed.
+    '''
+    __slots__ = ('cipher', 'buffer')
+
+    def __init__(self, key, iv):
+        self.cipher = AES.new(key, AES.MODE_CBC, iv)
+        self.buffer = bytearray()
+
+    def update(self, data):
+        self.buffer += data
+        # decrypt all complete blocks, except the last one
+        size = (len(self.buffer) - 1) // AES.block_size * AES.block_size
+        if size <= 0:
+            return b''
+        with memoryview(self.buffer) as view:
+            plain_data = self.cipher.decrypt(view[:size])
+        del self.buffer[:size]
+
+        return plain_data
+
+    def finalize(self):
+        if len(self.buffer) != AES.block_size:
+            raise ValueError(f'Encrypted segment is not a multiple of {AES.block_size} bytes')
+        plain_data = self.cipher.decrypt(bytes(self.buffer))
+        self.buffer.clear()
+
+        # remove PKCS7 padding
+        padding = plain_data[-1]
+        if padding < 1 or padding > AES.block_size or plain_data[-padding:] != bytes([padding]) * padding:
+            raise ValueError('Invalid padding in decrypted segment. Key/IV may be wrong.')
+
+        return plain_data[:-padding]
+
+
+class HlsDecrypter():
+    '''
+    Creates ciphers to decrypt the segments of AES-128 encrypted HLS streams in-process, instead of leaving it to ffmpeg.
+    - Supports key rotation (different key for a set of segments), and explicit IVs or IVs derived from the media sequence
+    - Encrypted initialization sections (maps) are decrypted as well. They require an explicit IV, as they have no media sequence.
+    - Keys are fetched once and cached, using `fetch_key(uri)`
+    '''
+    SUPPORTED_METHODS = ('AES-128', 'NONE')
+
+    def __init__(self, playlist, fetch_key):
+        self.logger = logging.getLogger()
+        self.playlist = playlist
+        self.fetch_key = fetch_key
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def is_supported(cls, playlist):
+        return all( key.method in cls.SUPPORTED_METHODS for key in playlist.keys ) and \
+                all( init_map.key_index is None or playlist.keys[init_map.key_index].method == 'NONE' or playlist.keys[init_map.key_index].iv
+                     for init_map in playlist.maps )
+
+    def _get_key(self, uri):
+        # lock is held while fetching, so that the key is fetched only once
+        with self.lock:
+            if uri not in self.keys:
+                self.logger.debug(f'Fetching decryption key from {uri}')
+                key = self.fetch_key(uri)
+                if len(key) != 16:
+                    raise ValueError(f'Invalid AES-128 key of {len(key)} bytes from {uri}')
+                self.keys[uri] = key
+
+        return self.keys[uri]
+
+    def prefetch_keys(self):
+        '''
+        fetch all the keys of the playlist upfront, so that segments do not wait for them
+        '''
+        for key in self.playlist.keys:
+            if key.method == 'AES-128':
+                self._get_key(key.uri)
+
+    def get_cipher(self, segment):
+        '''
+        Returns the cipher to decrypt the segment or initialization section (map), or None if it is not encrypted
+        '''
+        if segment.key_index is None:
+            return None
+        key = self.playlist.keys[segment.key_index]
+        if key.method == 'NONE':
+            return None
+
+        if key.iv:
+            # IV is a hexadecimal number (0x...) of 128 bits
+            iv = bytes.fromhex(key.iv[2:].zfill(32)[-32:])
+        else:
+            # IV is the media sequence number of the segment, if not given. Maps always have the IV (checked in `is_supported`).
+            iv = segment.media_sequence.to_bytes(16, 'big')
+
+        return SegmentCipher(self._get_key(key.uri), iv)
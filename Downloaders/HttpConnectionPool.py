@@ -0,0 +1,146 @@
+__author__ = 'Prudhvi PLN'
+
+import http.client
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class PooledResponse():
+    '''
+    Wrapper over http.client response which hands the connection back to the pool once the response is fully read
+    '''
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.released = False
+        # responses without body are complete as soon as they are received
+        self._check_release()
+
+    def _check_release(self):
+        if not self.released and self.response.isclosed():
+            self.released = True
+            self.pool.release(self.key, self.conn, reusable=not self.response.will_close)
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        self._check_release()
+        return data
+
+    def readinto(self, buffer):
+        size = self.response.readinto(buffer)
+        self._check_release()
+        return size
+
+    def close(self):
+        '''
+        Close the response. Connection is reused only if the response was fully read.
+        '''
+        if not self.released:
+            self.released = True
+            fully_read = self.response.isclosed()
+            self.response.close()
+            self.pool.release(self.key, self.conn, reusable=fully_read and not self.response.will_close)
+
+
+class HttpConnectionPool():
+    '''
+    Thread-safe pool of keep-alive http.client connections, keyed by host. Shared across all the downloaders.
+    - Idle connections are reused in LIFO order, so that the most recently used (least likely to be stale) is picked first
+    - Connections idle for more than `idle_timeout` seconds are dropped
+    - A request failing on a reused connection due to server closing it, is retried once on a new connection
+    '''
+    _shared_pool = None
+    _shared_lock = threading.Lock()
+    # errors raised when server has closed an idle keep-alive connection
+    STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+    def __init__(self, max_size=10, idle_timeout=15):
+        self.logger = logging.getLogger()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}      # host key -> list of (connection, last used time)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_shared_pool(cls, max_size):
+        '''
+        Returns the pool shared across downloaders. Pool size grows to the highest size requested.
+        '''
+        with cls._shared_lock:
+            if cls._shared_pool is None:
+                cls._shared_pool = cls(max_size)
+            cls._shared_pool.max_size = max(cls._shared_pool.max_size, max_size)
+
+        return cls._shared_pool
+
+    def _new_connection(self, key, timeout):
+        scheme, netloc = key
+        conn_class = http.client.HTTPConnection if scheme == 'http' else http.client.HTTPSConnection
+        return conn_class(netloc, timeout=timeout)
+
+    def _get_idle_connection(self, key):
+        '''
+        Returns the most recently used idle connection of the host, if not expired
+        '''
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                conn, last_used = conns.pop()
+                if time.monotonic() - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+
+    def release(self, key, conn, reusable=True):
+        '''
+        Hand back the connection to the pool. Closes it if not reusable or pool is full.
+        '''
+        if reusable:
+            with self.lock:
+                conns = self.idle.setdefault(key, [])
+                if len(conns) < self.max_size:
+                    conns.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def request(self, url, headers, timeout, method='GET'):
+        '''
+        Send request using a pooled connection and return the response wrapped as PooledResponse
+        '''
+        parsed_url = urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc)
+        path = parsed_url.path + ('?' + parsed_url.query if parsed_url.query else '')
+
+        conn = self._get_idle_connection(key)
+        if conn is not None:
+            try:
+                conn.timeout = timeout
+                if conn.sock: conn.sock.settimeout(timeout)
+                conn.request(method, path, headers=headers)
+                return PooledResponse(self, key, conn, conn.getresponse())
+            except self.STALE_ERRORS as e:
+                self.logger.debug(f'Reused connection to {parsed_url.netloc} is stale ({e.__class__.__name__}). Reconnecting...')
+                conn.close()
+            except Exception:
+                conn.close()
+                raise
+
+        conn = self._new_connection(key, timeout)
+        try:
+            conn.request(method, path, headers=headers)
+            return PooledResponse(self, key, conn, conn.getresponse())
+        except Exception:
+            conn.close()
+            raise
+
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
@@ -0,0 +1,54 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class MemoryBudget():
+    '''
+    Caps the bytes held in memory by all the downloads running in parallel (segments being downloaded, out-of-order segments of stream muxer etc.)
+    - `reserve(size)` blocks till the bytes are available, and releases them on exit
+    - `try_acquire(size)` does not block, and returns False if the bytes are not available
+    - A request bigger than the whole budget is allowed when nothing else is held, so that it never blocks forever
+    '''
+    def __init__(self, limit):
+        self.logger = logging.getLogger()
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def _can_acquire(self, size):
+        return self.used + size <= self.limit or self.used == 0
+
+    def _acquire(self, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def acquire(self, size):
+        with self.condition:
+            if not self._can_acquire(size):
+                self.logger.debug(f'Waiting for {size} bytes of memory budget. In use: {self.used}/{self.limit} bytes')
+                self.condition.wait_for(lambda: self._can_acquire(size))
+            self._acquire(size)
+
+    def try_acquire(self, size):
+        with self.condition:
+            if not self._can_acquire(size):
+                return False
+            self._acquire(size)
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
@@ -0,0 +1,72 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import os
+import threading
+import zlib
+
+
+class ResumeJournal():
+    '''
+    Append-only journal of the completed segments/chunks of a download, used to resume an interrupted download.
+    - Every completed item is recorded as a line: <item id> <size in bytes> <crc32>
+    - Items are written to a temporary file and renamed before recording, so a partially written item is never in the journal
+    - A torn last line (process killed while recording) is ignored on load, and the item is downloaded again
+    '''
+    def __init__(self, journal_file, verify=False):
+        self.logger = logging.getLogger()
+        self.journal_file = journal_file
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        entries = {}
+        if not os.path.isfile(self.journal_file):
+            return entries
+
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item_id, size, crc = line.rstrip('\n').split('\t')
+                    entries[item_id] = (int(size), int(crc, 16))
+                except ValueError:
+                    self.logger.debug(f'Ignoring invalid entry in resume journal: {line!r}')
+
+        self.logger.debug(f'Loaded {len(entries)} completed items from resume journal: {self.journal_file}')
+        return entries
+
+    def _checksum(self, file):
+        crc, size = 0, 0
+        with open(file, 'rb') as f:
+            while data := f.read(1024*1024):
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+
+        return size, crc
+
+    def is_complete(self, item_id, file=None):
+        '''
+        Check if the item is already downloaded. If file is given, it has to exist with the recorded size.
+        If verify is enabled, the checksum of the file is checked as well.
+        '''
+        entry = self.entries.get(item_id)
+        if entry is None:
+            return False
+
+        if file:
+            if not os.path.isfile(file) or os.path.getsize(file) != entry[0] or (self.verify and self._checksum(file) != entry):
+                self.logger.debug(f'Journal entry for {item_id} does not match with {file}. Downloading again...')
+                self.entries.pop(item_id, None)
+                return False
+
+        return True
+
+    def record(self, item_id, size, crc):
+        '''
+        Record the item as completed
+        '''
+        with self.lock:
+            self.entries[item_id] = (size, crc)
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(f'{item_id}\t{size}\t{crc:08x}\n')
@@ -0,0 +1,176 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import os
+import threading
+from subprocess import Popen, PIPE
+
+
+class StreamMuxer():
+    '''
+    Feeds HLS segments to an ffmpeg process over a pipe, in playlist order, as and when they are downloaded.
+    - Segments arriving out of order are held in memory, up to `window` segments (and within the memory budget, if given)
+    - Segments beyond the window are spilled to the temp directory and streamed from there when it is their turn
+    '''
+    def __init__(self, cmd, total_segments, spill_dir, window=32, memory_budget=None, block_size=64*1024):
+        self.logger = logging.getLogger()
+        self.cmd = cmd
+        self.total_segments = total_segments
+        self.spill_dir = spill_dir
+        self.window = window
+        self.memory_budget = memory_budget
+        self.block_size = block_size
+        self.next_index = 0         # index of the next segment to be written to ffmpeg
+        self.pending = {}           # out-of-order segments held in memory, with the bytes reserved from the memory budget
+        self.spilled = {}           # out-of-order segments spilled to disk
+        self.error = None
+        self.lock = threading.Lock()
+        self.log_file = os.path.join(self.spill_dir, 'ffmpeg.log')
+        self.proc = None
+
+    def start(self):
+        '''
+        Start the ffmpeg process which reads the segments from stdin
+        '''
+        self.logger.debug(f'Starting ffmpeg for stream muxing: {self.cmd}')
+        # ffmpeg logs are written to a file, as an unread stderr pipe can block ffmpeg
+        self._log = open(self.log_file, 'wb')
+        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=self._log, shell=True)
+
+    def _spill_file(self, index):
+        return os.path.join(self.spill_dir, f'spill_{index}.ts')
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except (BrokenPipeError, OSError) as e:
+            self.error = f'ffmpeg stopped accepting data: {e}'
+            raise Exception(self.error)
+
+    def _release(self, reserved):
+        if self.memory_budget and reserved:
+            self.memory_budget.release(reserved)
+
+    def _write_file(self, file):
+        # stream the file in blocks, instead of reading it fully into memory
+        with open(file, 'rb') as f:
+            while data := f.read(self.block_size):
+                self._write(data)
+        os.remove(file)
+
+    def _write_next(self):
+        '''
+        Writes the next in-order segment, if available. Returns False if it is not yet received.
+        '''
+        if self.next_index in self.pending:
+            data, reserved = self.pending.pop(self.next_index)
+            try:
+                self._write(data)
+            finally:
+                self._release(reserved)
+        elif self.next_index in self.spilled:
+            self._write_file(self.spilled.pop(self.next_index))
+        else:
+            return False
+
+        self.next_index += 1
+        return True
+
+    def _reserve(self, size):
+        '''
+        Returns the bytes reserved from the memory budget to hold a segment, or None if the budget is exhausted
+        '''
+        if self.memory_budget is None:
+            return 0
+        return size if self.memory_budget.try_acquire(size) else None
+
+    def is_done(self, index):
+        '''
+        Check if the segment is already received
+        '''
+        return index < self.next_index or index in self.pending or index in self.spilled
+
+    def add(self, index, data, reserved=0):
+        '''
+        Add a downloaded segment. Writes all the contiguous segments available to ffmpeg.
+        A segment received again (from a hedged request) is ignored.
+        `reserved` bytes of the memory budget held by the caller for the data are released once the data is written/spilled.
+        '''
+        with self.lock:
+            try:
+                if self.error:
+                    raise Exception(self.error)
+
+                if self.is_done(index):
+                    return
+
+                if index != self.next_index:
+                    # hold out-of-order segment till previous segments arrive. Bytes reserved by the caller are held with it.
+                    held = None
+                    if len(self.pending) < self.window:
+                        held = reserved or self._reserve(len(data))
+                    if held is not None:
+                        self.pending[index] = (data, held)
+                        reserved = 0
+                    else:
+                        with open(self._spill_file(index), 'wb') as f:
+                            f.write(data)
+                        self.spilled[index] = self._spill_file(index)
+                    return
+
+                self._write(data)
+                self.next_index += 1
+            finally:
+                self._release(reserved)
+
+            # flush the segments which were waiting for this segment
+            while self._write_next():
+                pass
+
+    def add_file(self, index, file):
+        '''
+        Add a downloaded segment, which is written to the given file (when it could not be held in memory). The muxer takes over the file and removes it once written.
+        '''
+        with self.lock:
+            if self.error:
+                raise Exception(self.error)
+
+            if self.is_done(index):
+                os.remove(file)
+                return
+
+            os.replace(file, self._spill_file(index))
+            self.spilled[index] = self._spill_file(index)
+            while self._write_next():
+                pass
+
+    def close(self):
+        '''
+        Close the pipe and wait for ffmpeg to complete muxing. Raises exception if any segment is missing or ffmpeg fails.
+        '''
+        if self.next_index < self.total_segments:
+            self.abort()
+            raise Exception(f'Stream muxing incomplete. Received {self.next_index} / {self.total_segments} segments in order')
+
+        self.proc.stdin.close()
+        rc = self.proc.wait()
+        self._log.close()
+        if rc != 0:
+            with open(self.log_file, 'r', encoding='utf-8', errors='ignore') as f:
+                raise Exception(f'Error occured: {f.read()}')
+
+    def abort(self):
+        '''
+        Stop ffmpeg and remove the spilled segments
+        '''
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if self.proc:
+            self._log.close()
+        for spill_file in self.spilled.values():
+            if os.path.exists(spill_file): os.remove(spill_file)
+        for _, reserved in self.pending.values():
+            self._release(reserved)
+        self.pending.clear()
+        self.spilled.clear()
@@ -0,0 +1,72 @@
+__author__ = 'Prudhvi PLN'
+
+import base64
+import threading
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.strxor import strxor
+
+
+class SubtitleDecrypter():
+    '''
+    Decrypts the text lines of subtitles, where every line is AES-CBC encrypted (with the same key/IV) and base64 encoded.
+    - Lines are decrypted in batches with a single AES call. As every line is a separate CBC message, the batch is decrypted
+      in ECB mode and every block is XORed with the previous encrypted block of its line (or with the IV, for the first block).
+    - Cipher is created once per key/IV and reused for all the lines
+    '''
+    BATCH_SIZE = 512
+
+    def __init__(self, key, iv):
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self.iv = iv
+        # cipher is shared by the subtitles decrypted in parallel
+        self.lock = threading.Lock()
+
+    def _decode(self, line):
+        # returns the encrypted bytes of the line, or None if it is not a valid encrypted line
+        try:
+            data = base64.b64decode(line)
+        except ValueError:
+            return None
+
+        return data if data and len(data) % AES.block_size == 0 else None
+
+    def _decrypt_batch(self, lines):
+        encrypted = [ self._decode(line) for line in lines ]
+        valid = [ data for data in encrypted if data is not None ]
+        if not valid:
+            return [None] * len(lines)
+
+        # previous encrypted block of every block: IV for the first block of a line, else the previous block of the line
+        chain = b''.join( self.iv + data[:-AES.block_size] for data in valid )
+        with self.lock:
+            plain_data = self.cipher.decrypt(b''.join(valid))
+        plain_data = strxor(plain_data, chain)
+
+        results, offset = [], 0
+        for data in encrypted:
+            if data is None:
+                results.append(None)
+                continue
+            message = plain_data[offset:offset + len(data)]
+            offset += len(data)
+            # remove the PKCS#7 padding. Invalid padding means the line was not encrypted with this key/IV.
+            pad = message[-1]
+            if not 1 <= pad <= AES.block_size or message[-pad:] != bytes([pad]) * pad:
+                results.append(None)
+                continue
+            try:
+                results.append(message[:-pad].decode('utf-8').strip())
+            except UnicodeDecodeError:
+                results.append(None)
+
+        return results
+
+    def decrypt_lines(self, lines):
+        '''
+        Returns the decrypted text of every line, or None for the lines which could not be decrypted
+        '''
+        results = []
+        for start in range(0, len(lines), self.BATCH_SIZE):
+            results.extend(self._decrypt_batch(lines[start:start + self.BATCH_SIZE]))
+
+        return results
@@ -0,0 +1,230 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import os
+import signal
+import threading
+import time
+import yaml
+from datetime import datetime
+
+
+class TokenBucket():
+    '''
+    Token bucket of `rate` bytes per second, holding up to `burst` bytes.
+    Bytes are taken even if the bucket runs short (as they are already received), and the caller waits till the debt is refilled.
+    '''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'lock')
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate          # allow a burst of one second by default
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        '''
+        Take the bytes from the bucket. Returns the seconds to wait, before taking more.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class BandwidthLimiter():
+    '''
+    Limits the bandwidth of all the downloads (segments, chunks, subtitles etc.), shared across parallel downloads.
+    - Global limit, with optional sub-limits per host. Limits are in bytes/sec, with K/M/G suffixes (ex: 500K, 2M). 0 for no limit.
+    - Global limit can vary by the time of the day, as per the schedule. ex: [{'from': '09:00', 'to': '18:00', 'limit': '1M'}]
+    - Limits can be changed at runtime through the control file (yaml with `limit` and `hosts`, or just the limit). It is checked every second,
+      or right away on SIGUSR1 (where supported).
+    '''
+    _shared_limiter = None
+    _shared_lock = threading.Lock()
+    # interval (in seconds) to re-evaluate the schedule & control file
+    REFRESH_INTERVAL = 1
+    UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.config = None
+        self.limit = 0
+        self.host_limits = {}
+        self.schedule = []
+        self.control_file = None
+        self.control_mtime = None
+        self.control_limits = None      # (limit, host limits) set through control file
+        # limits in effect, after applying the schedule & control file
+        self.active_limit = None
+        self.active_host_limits = {}
+        self.bucket = None
+        self.host_buckets = {}          # bucket of every host seen, None if the host is not limited
+        self.limited = False
+        self.next_refresh = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_limiter(cls):
+        '''
+        Returns the limiter shared across downloaders
+        '''
+        with cls._shared_lock:
+            if cls._shared_limiter is None:
+                cls._shared_limiter = cls()
+
+        return cls._shared_limiter
+
+    @classmethod
+    def parse_rate(cls, rate):
+        '''
+        Returns the rate in bytes/sec. ex: 500K -> 512000
+        '''
+        if not rate:
+            return 0
+        rate = str(rate).strip().upper().removesuffix('B').removesuffix('/S')
+        multiplier = cls.UNITS.get(rate[-1:], 1)
+        if rate[-1:] in cls.UNITS: rate = rate[:-1]
+
+        return int(float(rate) * multiplier)
+
+    def configure(self, limit=0, host_limits=None, schedule=None, control_file=None):
+        '''
+        Set the limits from downloader config. Ignored if the config is unchanged, so that the buckets are not reset by every downloader.
+        '''
+        config = (limit, repr(host_limits), repr(schedule), control_file)
+        with self.lock:
+            if config == self.config:
+                return
+            self.config = config
+            try:
+                self.limit = self.parse_rate(limit)
+                self.host_limits = { host: self.parse_rate(rate) for host, rate in (host_limits or {}).items() }
+                self.schedule = [ (self._parse_time(entry['from']), self._parse_time(entry['to']), self.parse_rate(entry.get('limit'))) for entry in (schedule or []) ]
+            except (KeyError, ValueError, TypeError) as e:
+                self.logger.warning(f'Invalid bandwidth limits in config: {e}. Bandwidth is not limited.')
+                self.limit, self.host_limits, self.schedule = 0, {}, []
+            self.control_file = control_file
+            self.control_mtime = None
+            self.control_limits = None
+            self._refresh()
+
+    def register_signal(self):
+        '''
+        Reload the control file on SIGUSR1. Has to be called from the main thread. Not supported on Windows.
+        '''
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.reload())
+        except ValueError:
+            self.logger.debug('Bandwidth limiter signal is not registered, as it is not the main thread')
+
+    def reload(self):
+        '''
+        re-evaluate the limits right away, instead of waiting for the next refresh
+        '''
+        self.next_refresh = 0
+
+    def _parse_time(self, value):
+        # HH:MM -> minutes since midnight. yaml parses unquoted HH:MM as sexagesimal int, which is already in minutes.
+        if isinstance(value, int):
+            return value % 1440
+        hours, minutes = str(value).split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def _get_scheduled_limit(self):
+        now = datetime.now()
+        minutes = now.hour * 60 + now.minute
+        for start, end, limit in self.schedule:
+            # schedule can span midnight. ex: 22:00 to 06:00
+            if (start <= minutes < end) if start <= end else (minutes >= start or minutes < end):
+                return limit
+
+        return self.limit
+
+    def _read_control_file(self):
+        '''
+        Returns (limit, host limits) from the control file, or None if it is not present
+        '''
+        if not self.control_file or not os.path.isfile(self.control_file):
+            self.control_mtime = None
+            return None
+
+        mtime = os.path.getmtime(self.control_file)
+        if mtime == self.control_mtime:
+            return self.control_limits
+
+        self.control_mtime = mtime
+        try:
+            with open(self.control_file, 'r', encoding='utf-8') as f:
+                content = yaml.safe_load(f)
+            if isinstance(content, dict):
+                limit = self.parse_rate(content['limit']) if 'limit' in content else None
+                host_limits = { host: self.parse_rate(rate) for host, rate in content['hosts'].items() } if content.get('hosts') is not None else None
+                return limit, host_limits
+            return self.parse_rate(content), None
+        except Exception as e:
+            self.logger.warning(f'Failed to read bandwidth control file {self.control_file}: {e}')
+            return self.control_limits
+
+    def _refresh(self):
+        '''
+        re-evaluate the limits as per the schedule & control file, and reset the buckets if the limits have changed
+        '''
+        self.next_refresh = time.monotonic() + self.REFRESH_INTERVAL
+        self.control_limits = self._read_control_file()
+        limit, host_limits = self.control_limits or (None, None)
+        if limit is None: limit = self._get_scheduled_limit()
+        if host_limits is None: host_limits = self.host_limits
+
+        if limit == self.active_limit and host_limits == self.active_host_limits:
+            return
+
+        host_status = ', '.join( f'{host}: {self._format_rate(rate)}' for host, rate in host_limits.items() )
+        # no need to report, if bandwidth was never limited
+        log = self.logger.info if self.limited or limit or host_status else self.logger.debug
+        log(f'Bandwidth limit: {self._format_rate(limit)}' + (f' | Per host: {host_status}' if host_status else ''))
+        self.active_limit, self.active_host_limits = limit, host_limits
+        self.bucket = TokenBucket(limit) if limit > 0 else None
+        self.host_buckets = {}
+        self.limited = self.bucket is not None or any( rate > 0 for rate in host_limits.values() )
+
+    def _format_rate(self, rate):
+        return f'{rate / 1024:.0f} KB/s' if rate else 'unlimited'
+
+    def _get_host_bucket(self, host):
+        if host not in self.host_buckets:
+            # host limit applies to its sub-domains as well
+            rate = next(( rate for limit_host, rate in self.active_host_limits.items() if host == limit_host or host.endswith(f'.{limit_host}') ), 0)
+            self.host_buckets[host] = TokenBucket(rate) if rate > 0 else None
+
+        return self.host_buckets[host]
+
+    def throttle(self, host, size):
+        '''
+        Account the bytes received from the host, and wait if the global or host limit is exceeded
+        '''
+        if time.monotonic() >= self.next_refresh:
+            with self.lock:
+                if time.monotonic() >= self.next_refresh:
+                    self._refresh()
+
+        if not self.limited:
+            return
+
+        bucket, host_bucket = self.bucket, self._get_host_bucket(host)
+        wait_time = max(bucket.take(size) if bucket else 0, host_bucket.take(size) if host_bucket else 0)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def iter_throttled(self, blocks, host):
+        '''
+        throttle the blocks of a response as they are received
+        '''
+        for block in blocks:
+            self.throttle(host, len(block))
+            yield block
@@ -0,0 +1,147 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised when a request is not sent, as the host is marked unhealthy.
+    Holds the seconds after which the host is probed again, and the seconds for which the host has been unavailable.
+    '''
+    def __init__(self, message, retry_after=None, unavailable_for=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.unavailable_for = unavailable_for
+
+
+class HostHealth():
+    '''
+    Health stats of a single host
+    '''
+    def __init__(self):
+        self.state = 'closed'           # closed: healthy, open: requests are rejected, half-open: a probe request is in-flight
+        self.consecutive_failures = 0
+        self.error_rate = 0.0           # moving average of failures
+        self.latency = None             # moving average of response time in seconds
+        self.opened_at = 0
+        self.unavailable_since = None   # time when the circuit was first opened, till the host is healthy again
+
+
+class HostHealthRegistry():
+    '''
+    Circuit breaker per host, shared across the clients and the downloaders.
+    - After `failure_threshold` consecutive failures (5xx, timeouts, connection errors), circuit of the host is opened
+      and requests to it fail fast, instead of waiting for the request timeout
+    - After `cooldown` seconds, a single probe request is let through (half-open). Circuit is closed if it succeeds, else opened again.
+    - Error rate & latency are tracked for reporting the health of the host
+    '''
+    _shared_registry = None
+    _shared_lock = threading.Lock()
+    # weight of the latest request in the moving averages
+    SMOOTHING = 0.2
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.logger = logging.getLogger()
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+        # notified when the result of a probe request is recorded
+        self.probe_done = threading.Condition(self.lock)
+
+    @classmethod
+    def get_registry(cls):
+        '''
+        Returns the registry shared across clients and downloaders
+        '''
+        with cls._shared_lock:
+            if cls._shared_registry is None:
+                cls._shared_registry = cls()
+
+        return cls._shared_registry
+
+    def configure(self, failure_threshold=None, cooldown=None):
+        if failure_threshold is not None: self.failure_threshold = failure_threshold
+        if cooldown is not None: self.cooldown = cooldown
+
+    def _get_host(self, url):
+        return urlsplit(url).netloc
+
+    def _get_health(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostHealth()
+        return self.hosts[host]
+
+    def check(self, url):
+        '''
+        Check if request can be sent to the host of the url. Raises CircuitOpenError if the host is unhealthy.
+        '''
+        host = self._get_host(url)
+        with self.lock:
+            health = self._get_health(host)
+            if health.state == 'closed':
+                return
+
+            now = time.monotonic()
+            wait_time = health.opened_at + self.cooldown - now
+            if health.state == 'open' and wait_time <= 0:
+                # let this request through as a probe
+                self.logger.debug(f'Probing host {host} after cooldown of {self.cooldown}s')
+                health.state = 'half-open'
+                return
+
+            # retry once the host can be probed again. If the probe is still running, right away, as the retry waits for its result in `wait_for_probe`.
+            raise CircuitOpenError(f'Host {host} is unavailable after repeated failures', max(wait_time, 0), now - health.unavailable_since)
+
+    def wait_for_probe(self, url):
+        '''
+        While a probe request to the host of the url is in-flight, wait for its result (up to cooldown), instead of being rejected right away.
+        Called before taking a connection slot, so that the requests to a host which is down do not hold the slots of healthy hosts.
+        '''
+        with self.lock:
+            health = self.hosts.get(self._get_host(url))
+            if health is not None and health.state == 'half-open':
+                self.probe_done.wait_for(lambda: health.state != 'half-open', timeout=self.cooldown)
+
+    def record(self, url, success, latency=None):
+        '''
+        Record the outcome of a request to the host of the url
+        '''
+        host = self._get_host(url)
+        with self.lock:
+            health = self._get_health(host)
+            if health.state == 'half-open':
+                # wake up the requests waiting for the result of the probe, once the state is updated
+                self.probe_done.notify_all()
+            health.error_rate += self.SMOOTHING * ((0 if success else 1) - health.error_rate)
+            if latency is not None:
+                health.latency = latency if health.latency is None else health.latency + self.SMOOTHING * (latency - health.latency)
+
+            if success:
+                if health.state != 'closed':
+                    self.logger.info(f'Host {host} is healthy again')
+                health.state = 'closed'
+                health.consecutive_failures = 0
+                health.unavailable_since = None
+                return
+
+            health.consecutive_failures += 1
+            if health.state == 'half-open' or (health.state == 'closed' and health.consecutive_failures >= self.failure_threshold):
+                latency = f'{health.latency:.2f}s' if health.latency is not None else 'NA'
+                self.logger.warning(f'Host {host} failed {health.consecutive_failures} consecutive requests (error rate: {health.error_rate:.0%}, avg latency: {latency}). Pausing requests for {self.cooldown}s')
+                health.state = 'open'
+                health.opened_at = time.monotonic()
+                if health.unavailable_since is None: health.unavailable_since = health.opened_at
+
+    def is_available(self, url):
+        '''
+        Returns False if circuit of the host is open and cooldown has not elapsed
+        '''
+        with self.lock:
+            health = self.hosts.get(self._get_host(url))
+            if health is None or health.state == 'closed':
+                return True
+            return health.state == 'open' and time.monotonic() - health.opened_at >= self.cooldown
@@ -0,0 +1,139 @@
+__author__ = 'Prudhvi PLN'
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class HttpCache():
+    '''
+    On-disk cache of metadata responses (search results, series details, subtitle lists etc.), shared across runs.
+    - Only urls matching one of the `ttls` patterns are cached, for the seconds configured for the pattern
+    - Stale entries with an ETag/Last-Modified are revalidated with a conditional request, instead of downloading them again
+    - Least recently used entries are evicted once the cache grows beyond `max_size_mb`
+    - Media segments and keys are never cached
+    '''
+    # urls of segments & keys, which should never be cached
+    EXCLUDED_URLS = re.compile(r'\.(ts|m4s|mp4|aac|key)(\?|$)', re.IGNORECASE)
+
+    def __init__(self, cache_dir, ttls=None, max_size_mb=50, ignore_params=None):
+        self.logger = logging.getLogger()
+        self.cache_dir = cache_dir
+        self.ttls = ttls or {}
+        self.max_size = max_size_mb * 1024 * 1024
+        # query params which change on every run (like tokens), but not the response
+        self.ignore_params = ignore_params or []
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_size = sum( entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json') )
+
+    def get_ttl(self, url):
+        '''
+        Returns seconds for which response of the url is cached, or None if url should not be cached
+        '''
+        if self.EXCLUDED_URLS.search(url):
+            return None
+        for pattern, ttl in self.ttls.items():
+            if pattern in url:
+                return ttl
+
+    def _get_path(self, url):
+        # drop the ignored query params from the url, so that the entry is found even if they change
+        parts = urlsplit(url)
+        query = urlencode([ (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in self.ignore_params ])
+        key = urlunsplit(parts._replace(query=query))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        '''
+        Returns the cached entry of the url (even if it is stale), or None if not cached
+        '''
+        path = self._get_path(url)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            # mark the entry as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return entry
+
+    def is_fresh(self, entry):
+        return entry['expires_at'] > time.time()
+
+    def get_validators(self, entry):
+        '''
+        Returns the headers to revalidate a stale entry
+        '''
+        headers = {}
+        if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, body, headers, ttl):
+        '''
+        Store the response body of the url along with its validators
+        '''
+        entry = {
+            'url': url,
+            'body': body,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'expires_at': time.time() + ttl
+        }
+        self._write(self._get_path(url), entry)
+        self.logger.debug(f'Cached response of {url = } for {ttl}s')
+
+    def refresh(self, url, entry, ttl):
+        '''
+        Extend the expiry of an entry, which is revalidated as not modified
+        '''
+        entry['expires_at'] = time.time() + ttl
+        self._write(self._get_path(url), entry)
+        self.logger.debug(f'Revalidated cached response of {url = }')
+
+    def _write(self, path, entry):
+        data = json.dumps(entry).encode('utf-8')
+        temp_path = f'{path}.{threading.get_ident()}.part'
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        # write to a temp file and rename, so that a partially written entry is never read
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.cache_size += len(data) - old_size
+            if self.cache_size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        '''
+        Remove least recently used entries, till the cache is within 90% of its max size
+        '''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        self.cache_size = sum( size for _, size, _ in entries )
+        for _, size, path in sorted(entries):
+            if self.cache_size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.cache_size -= size
+            except OSError:
+                pass
+
+        self.logger.debug(f'Evicted least recently used entries from http cache. Current size: {self.cache_size / (1024**2):.2f} MB')
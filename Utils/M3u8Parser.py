@@ -0,0 +1,236 @@
+__author__ = 'Prudhvi PLN'
+
+import re
+from urllib.parse import urljoin
+
+
+class M3u8Key():
+    '''
+    Encryption details of the segments, from #EXT-X-KEY
+    '''
+    __slots__ = ('method', 'uri', 'iv', 'key_format')
+
+    def __init__(self, method, uri=None, iv=None, key_format=None):
+        self.method = method
+        self.uri = uri
+        self.iv = iv
+        self.key_format = key_format
+
+
+class M3u8Map():
+    '''
+    Initialization section of the segments (like fMP4 header), from #EXT-X-MAP
+    - key_index: index of the key in the playlist, with which the section is encrypted, or None
+    '''
+    __slots__ = ('uri', 'byte_range', 'key_index')
+
+    def __init__(self, uri, byte_range=None, key_index=None):
+        self.uri = uri
+        self.byte_range = byte_range
+        self.key_index = key_index
+
+
+class M3u8Variant():
+    '''
+    Resolution stream of a master playlist, from #EXT-X-STREAM-INF
+    '''
+    __slots__ = ('uri', 'resolution', 'name', 'bandwidth')
+
+    def __init__(self, uri, resolution=None, name=None, bandwidth=None):
+        self.uri = uri
+        self.resolution = resolution
+        self.name = name
+        self.bandwidth = bandwidth
+
+
+class M3u8Segment():
+    '''
+    Media segment of a playlist.
+    - byte_range: (length, offset) if only a part of the uri is the segment, else None
+    - key_index/map_index: index of the key/map in the playlist applicable to the segment, or None
+    '''
+    __slots__ = ('uri', 'duration', 'byte_range', 'key_index', 'map_index', 'discontinuity', 'media_sequence')
+
+    def __init__(self, uri, duration, byte_range, key_index, map_index, discontinuity, media_sequence):
+        self.uri = uri
+        self.duration = duration
+        self.byte_range = byte_range
+        self.key_index = key_index
+        self.map_index = map_index
+        self.discontinuity = discontinuity
+        self.media_sequence = media_sequence
+
+
+class M3u8Playlist():
+    '''
+    Parsed master/media playlist. Uris are resolved to absolute urls.
+    '''
+    __slots__ = ('url', 'variants', 'segments', 'keys', 'maps', 'target_duration', 'media_sequence', 'is_endlist')
+
+    def __init__(self, url=None):
+        self.url = url
+        self.variants = []
+        self.segments = []
+        self.keys = []
+        self.maps = []
+        self.target_duration = None
+        self.media_sequence = 0
+        self.is_endlist = False
+
+    @property
+    def is_master(self):
+        return len(self.variants) > 0
+
+    @property
+    def duration(self):
+        return sum( segment.duration for segment in self.segments )
+
+    @property
+    def is_encrypted(self):
+        return any( key.method != 'NONE' for key in self.keys )
+
+    def get_segment_urls(self):
+        '''
+        urls of all the segments, without duplicates, in playlist order
+        '''
+        return list(dict.fromkeys( segment.uri for segment in self.segments ))
+
+    def dumps(self, segment_path, key_path=None, map_path=None, include_keys=True):
+        '''
+        Returns the playlist as m3u8 text, with uris of the segments/keys/maps replaced by the paths returned by the given functions.
+        Keys are not included if `include_keys` is False (i.e., segments are already decrypted).
+        '''
+        lines = ['#EXTM3U']
+        if self.target_duration is not None: lines.append(f'#EXT-X-TARGETDURATION:{self.target_duration}')
+        lines.append(f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}')
+
+        key_index = map_index = None
+        for segment in self.segments:
+            if segment.discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            if include_keys and segment.key_index != key_index:
+                key_index = segment.key_index
+                key = self.keys[key_index]
+                key_line = f'#EXT-X-KEY:METHOD={key.method}'
+                if key.uri: key_line += f',URI="{key_path(key) if key_path else key.uri}"'
+                if key.iv: key_line += f',IV={key.iv}'
+                if key.key_format: key_line += f',KEYFORMAT="{key.key_format}"'
+                lines.append(key_line)
+            if segment.map_index != map_index:
+                map_index = segment.map_index
+                init_map = self.maps[map_index]
+                lines.append(f'#EXT-X-MAP:URI="{map_path(init_map) if map_path else init_map.uri}"')
+            lines.append(f'#EXTINF:{segment.duration},')
+            lines.append(segment_path(segment))
+
+        if self.is_endlist: lines.append('#EXT-X-ENDLIST')
+
+        return '\n'.join(lines) + '\n'
+
+
+class M3u8Parser():
+    '''
+    Incremental parser of master/media playlists. Feed the playlist text (all at once or as it arrives) and call `close()` to get the playlist.
+    - Every line is parsed exactly once, and tags are applied to the next segment/variant
+    - Supports multiple keys (key rotation), maps, byte ranges & discontinuities
+    '''
+    # attributes of a tag. ex: METHOD=AES-128,URI="https://...",IV=0x...
+    ATTRIBUTES_REGEX = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+    def __init__(self, url=None):
+        self.playlist = M3u8Playlist(url)
+        self.buffer = ''
+        # state applicable to the next segment
+        self.duration = None
+        self.byte_range = None
+        self.discontinuity = False
+        self.key_index = None
+        self.map_index = None
+        self.variant = None
+        # offset of the next segment in the uri, when byte range offset is not given
+        self.next_offset = {}
+
+    @classmethod
+    def parse(cls, data, url=None):
+        parser = cls(url)
+        parser.feed(data)
+        return parser.close()
+
+    def _get_url(self, uri):
+        return urljoin(self.playlist.url, uri) if self.playlist.url else uri
+
+    def _get_attributes(self, value):
+        return { k: v.strip('"') for k, v in self.ATTRIBUTES_REGEX.findall(value) }
+
+    def _parse_byte_range(self, value, uri=None):
+        # <length>[@<offset>]. If offset is not given, segment starts after the previous segment of the same uri
+        length, _, offset = value.partition('@')
+        return int(length), int(offset) if offset else self.next_offset.get(uri, 0)
+
+    def feed(self, data):
+        lines = (self.buffer + data).split('\n')
+        # last line may be incomplete. retain it till the next feed.
+        self.buffer = lines.pop()
+        for line in lines:
+            self._parse_line(line.strip())
+
+    def close(self):
+        if self.buffer:
+            self._parse_line(self.buffer.strip())
+            self.buffer = ''
+        return self.playlist
+
+    def _parse_line(self, line):
+        if not line:
+            return
+
+        if not line.startswith('#'):
+            self._add_uri(line)
+            return
+
+        tag, _, value = line.partition(':')
+        if tag == '#EXTINF':
+            self.duration = float(value.split(',')[0] or 0)
+        elif tag == '#EXT-X-BYTERANGE':
+            self.byte_range = value
+        elif tag == '#EXT-X-DISCONTINUITY':
+            self.discontinuity = True
+        elif tag == '#EXT-X-KEY':
+            attributes = self._get_attributes(value)
+            uri = attributes.get('URI')
+            self.playlist.keys.append(M3u8Key(attributes.get('METHOD', 'NONE'), self._get_url(uri) if uri else None, attributes.get('IV'), attributes.get('KEYFORMAT')))
+            self.key_index = len(self.playlist.keys) - 1
+        elif tag == '#EXT-X-MAP':
+            attributes = self._get_attributes(value)
+            uri = self._get_url(attributes['URI'])
+            byte_range = self._parse_byte_range(attributes['BYTERANGE'], uri) if attributes.get('BYTERANGE') else None
+            # map is encrypted with the key in effect, same as the segments
+            self.playlist.maps.append(M3u8Map(uri, byte_range, self.key_index))
+            self.map_index = len(self.playlist.maps) - 1
+        elif tag == '#EXT-X-STREAM-INF':
+            attributes = self._get_attributes(value)
+            bandwidth = attributes.get('BANDWIDTH')
+            self.variant = M3u8Variant(None, attributes.get('RESOLUTION'), attributes.get('NAME'), int(bandwidth) if bandwidth and bandwidth.isdigit() else None)
+        elif tag == '#EXT-X-TARGETDURATION':
+            self.playlist.target_duration = int(float(value))
+        elif tag == '#EXT-X-MEDIA-SEQUENCE':
+            self.playlist.media_sequence = int(value)
+        elif tag == '#EXT-X-ENDLIST':
+            self.playlist.is_endlist = True
+
+    def _add_uri(self, line):
+        url = self._get_url(line)
+        if self.variant is not None:
+            self.variant.uri = url
+            self.playlist.variants.append(self.variant)
+            self.variant = None
+            return
+
+        byte_range = None
+        if self.byte_range is not None:
+            byte_range = self._parse_byte_range(self.byte_range, url)
+            self.next_offset[url] = byte_range[1] + byte_range[0]
+
+        media_sequence = self.playlist.media_sequence + len(self.playlist.segments)
+        self.playlist.segments.append(M3u8Segment(url, self.duration or 0, byte_range, self.key_index, self.map_index, self.discontinuity, media_sequence))
+        self.duration, self.byte_range, self.discontinuity = None, None, False
@@ -0,0 +1,137 @@
+__author__ = 'Prudhvi PLN'
+
+import logging
+import struct
+
+
+class Mp4Probe():
+    '''
+    Reads the duration, resolution & size of a remote MP4 (ISO-BMFF) file by fetching only its `moov` box using range requests.
+    - Top-level boxes are walked using their headers, so the moov box is found whether it is placed before or after the media data
+    - `fetch_range(start, end)` should return (data, total file size) for the inclusive byte range
+    '''
+    # bytes fetched at once while looking for the moov box
+    READ_SIZE = 64*1024
+    # moov box of even long videos is a few MBs. Anything bigger is not a valid moov box.
+    MAX_MOOV_SIZE = 64*1024*1024
+
+    def __init__(self, fetch_range):
+        self.logger = logging.getLogger()
+        self.fetch_range = fetch_range
+
+    def _iter_boxes(self, data, start=0, end=None):
+        '''
+        iterate over the boxes in data. Yields (box type, start of box data, end of box)
+        '''
+        end = len(data) if end is None else end
+        offset = start
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from('>I4s', data, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', data, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size:
+                raise Exception(f'Invalid size of box [{box_type}] at {offset}')
+
+            yield box_type, offset + header_size, min(offset + size, end)
+            offset += size
+
+    def _find_moov(self):
+        '''
+        walk through the top-level boxes and return the data of moov box & file size
+        '''
+        offset = 0
+        data, file_size = self.fetch_range(0, self.READ_SIZE - 1)
+        while True:
+            if len(data) < 16:
+                raise Exception('moov box not found')
+
+            size, box_type = struct.unpack_from('>I4s', data, 0)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from('>Q', data, 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size:
+                raise Exception(f'Invalid size of box [{box_type}] at {offset}')
+
+            if box_type == b'moov':
+                if size > self.MAX_MOOV_SIZE:
+                    raise Exception(f'moov box is too big ({size} bytes)')
+                if len(data) < size:
+                    data, _ = self.fetch_range(offset, offset + size - 1)
+                return data[header_size:size], file_size
+
+            # skip the box. Fetch again, only if the next box is not already available.
+            offset += size
+            if offset >= file_size:
+                raise Exception('moov box not found')
+            if size + 16 <= len(data):
+                data = data[size:]
+            else:
+                data, _ = self.fetch_range(offset, min(offset + self.READ_SIZE, file_size) - 1)
+
+    def _get_child(self, data, start, end, box_type):
+        for child_type, child_start, child_end in self._iter_boxes(data, start, end):
+            if child_type == box_type:
+                return child_start, child_end
+        return None, None
+
+    def _parse_duration(self, data, start):
+        '''
+        duration in seconds from mvhd box
+        '''
+        version = data[start]
+        if version == 1:
+            timescale, duration = struct.unpack_from('>IQ', data, start + 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', data, start + 12)
+
+        return duration / timescale if timescale else 0
+
+    def _parse_resolution(self, data, trak_start, trak_end):
+        '''
+        resolution (width, height) of the track if it is a video track, else None
+        '''
+        mdia_start, mdia_end = self._get_child(data, trak_start, trak_end, b'mdia')
+        if mdia_start is None: return None
+        hdlr_start, _ = self._get_child(data, mdia_start, mdia_end, b'hdlr')
+        if hdlr_start is None or data[hdlr_start + 8:hdlr_start + 12] != b'vide':
+            return None
+
+        # coded size from the visual sample entry (mdia > minf > stbl > stsd)
+        box = (mdia_start, mdia_end)
+        for box_type in (b'minf', b'stbl', b'stsd'):
+            box = self._get_child(data, *box, box_type)
+            if box[0] is None: break
+        else:
+            # skip version/flags & entry count of stsd and the header of the first sample entry
+            entry_start = box[0] + 8 + 8
+            width, height = struct.unpack_from('>HH', data, entry_start + 24)
+            if width and height:
+                return width, height
+
+        # fallback to presentation size from tkhd box, stored as 16.16 fixed point numbers at its end
+        tkhd_start, tkhd_end = self._get_child(data, trak_start, trak_end, b'tkhd')
+        if tkhd_start is None: return None
+        width, height = struct.unpack_from('>II', data, tkhd_end - 8)
+        return width >> 16, height >> 16
+
+    def probe(self):
+        '''
+        Returns: (duration in seconds, size in bytes, resolution as 'WxH' or None)
+        '''
+        moov, file_size = self._find_moov()
+        duration, resolution = 0, None
+        for box_type, start, end in self._iter_boxes(moov):
+            if box_type == b'mvhd':
+                duration = self._parse_duration(moov, start)
+            elif box_type == b'trak' and resolution is None:
+                track_resolution = self._parse_resolution(moov, start, end)
+                if track_resolution: resolution = f'{track_resolution[0]}x{track_resolution[1]}'
+
+        return duration, file_size, resolution
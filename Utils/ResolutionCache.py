@@ -0,0 +1,124 @@
+__author__ = 'Prudhvi PLN'
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlsplit
+
+
+class ResolutionCache():
+    '''
+    Persisted cache of the resolved links of episodes, keyed by client & episode id.
+    - Entries expire after `ttl` seconds, or earlier if the links are signed with an expiry time
+    - Expired entries are not removed right away. Caller can validate them (by probing the link) and extend their expiry.
+    '''
+    # query params of signed urls holding the expiry time (as epoch)
+    EXPIRY_PARAMS = ('expires', 'expire', 'exp', 'expiry', 'validto', 'valid_to', 'deadline', 'x-expires')
+    # links signed to expire within these many seconds are not re-used
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, cache_file, ttl=3600):
+        self.logger = logging.getLogger()
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def _load(self):
+        # loaded only once, when the cache is used for the first time
+        if self.entries is None:
+            self.entries = {}
+            if os.path.isfile(self.cache_file):
+                try:
+                    with open(self.cache_file, encoding='utf-8') as f:
+                        self.entries = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.logger.warning(f'Failed to load resolution cache [{self.cache_file}]. Error: {e}')
+
+        # remove entries which can no longer be re-used
+        now = time.time()
+        self.entries = { k: v for k, v in self.entries.items() if not self._is_signed_expired(v, now) }
+
+    def _save(self):
+        # write to a temp file and rename, so that a partially written file is never read
+        temp_file = f'{self.cache_file}.{threading.get_ident()}.part'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_file, self.cache_file)
+
+    def _get_key(self, client, episode_id):
+        return f'{client}:{episode_id}'
+
+    def _is_signed_expired(self, entry, now):
+        return entry.get('signed_expiry') is not None and now >= entry['signed_expiry'] - self.EXPIRY_MARGIN
+
+    def get_signed_expiry(self, urls):
+        '''
+        Returns the earliest expiry time (as epoch) of the signed urls, or None if the urls are not signed with an expiry
+        '''
+        expiry_times = []
+        for url in urls:
+            params = { k.lower(): v for k, v in parse_qsl(urlsplit(url).query) }
+            for param in self.EXPIRY_PARAMS:
+                if params.get(param, '').isdigit():
+                    expiry = int(params[param])
+                    expiry = expiry / 1000 if expiry > 1e11 else expiry     # milliseconds to seconds
+                    if expiry > 1e9: expiry_times.append(expiry)
+            # AWS signed urls: X-Amz-Date=20250101T000000Z&X-Amz-Expires=3600
+            if params.get('x-amz-date') and params.get('x-amz-expires', '').isdigit():
+                try:
+                    signed_at = datetime.strptime(params['x-amz-date'], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+                    expiry_times.append(signed_at.timestamp() + int(params['x-amz-expires']))
+                except ValueError:
+                    pass
+
+        return min(expiry_times) if expiry_times else None
+
+    def get(self, client, episode_id):
+        '''
+        Returns (cached data, True if entry is fresh else False), or (None, False) if not cached or the signed links are expired
+        '''
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self._get_key(client, episode_id))
+
+        if entry is None:
+            return None, False
+
+        return entry['data'], time.time() < entry['expires_at']
+
+    def put(self, client, episode_id, data, urls):
+        '''
+        Cache the resolved data of an episode. Expiry is based on the ttl, or the expiry of signed urls if earlier.
+        '''
+        now = time.time()
+        signed_expiry = self.get_signed_expiry(urls)
+        expires_at = now + self.ttl if signed_expiry is None else min(now + self.ttl, signed_expiry - self.EXPIRY_MARGIN)
+        with self.lock:
+            self._load()
+            self.entries[self._get_key(client, episode_id)] = { 'data': data, 'expires_at': expires_at, 'signed_expiry': signed_expiry }
+            self._save()
+
+        self.logger.debug(f'Cached resolved links of {episode_id = } till {datetime.fromtimestamp(expires_at)}')
+
+    def refresh(self, client, episode_id):
+        '''
+        Extend the expiry of an entry, after validating its links
+        '''
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self._get_key(client, episode_id))
+            if entry:
+                expires_at = time.time() + self.ttl
+                if entry['signed_expiry'] is not None: expires_at = min(expires_at, entry['signed_expiry'] - self.EXPIRY_MARGIN)
+                entry['expires_at'] = expires_at
+                self._save()
+
+    def remove(self, client, episode_id):
+        with self.lock:
+            self._load()
+            if self.entries.pop(self._get_key(client, episode_id), None) is not None:
+                self._save()
@@ -43,6 +43,22 @@ class ExitException(Exception):
     '''
     pass
 
+class DownloadError(Exception):
+    '''
+    Custom exception for failed download of a segment/chunk.
+    Holds HTTP status code & Retry-After (in seconds) sent by the server, if available.
+    '''
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class DownloadSuperseded(Exception):
+    '''
+    Custom exception to stop a duplicate (hedged) download of a segment/chunk, as the other request has completed it.
+    '''
+    pass
+
 class VersionManager():
     '''
     VersionManager to handle version checks and updates to UDB
@@ -12,8 +12,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from Utils.commons import load_yaml
 from Clients.KissKhClient import KissKhClient
-from Downloaders.HLSDownloader import HLSDownloader
-from Downloaders.BaseDownloader import BaseDownloader
+from Downloaders.DownloadScheduler import DownloadScheduler
 
 def try_import_msvcrt():
     """Try to import msvcrt module for Windows, return False if not available"""
@@ -36,6 +35,8 @@ def main():
     parser.add_argument('-p','--profile', default='Drama (Asianbxkiun)', help='Profile name from config')
     parser.add_argument('-d','--download', action='store_true', default='-d', help='Start download after link fetch')
     parser.add_argument('-id', '--drama-id', type=int, help='Direct drama ID from kisskh.ovh site')
+    parser.add_argument('--resolve-first', action='store_true', help='Resolve links of all episodes before starting the downloads')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use cached search results, series details & resolved links')
 
     args = parser.parse_args()
     
@@ -53,6 +54,10 @@ def main():
         print(f"[ERROR] Config profile '{args.profile}' not found.")
         sys.exit(1)
 
+    if args.no_cache:
+        config['http_cache'] = None
+        config['resolution_cache_ttl'] = 0
+
     client = KissKhClient(config)
 
     if args.drama_id:
@@ -130,42 +135,68 @@ def main():
         'specific_no': list(map(int, args.specific.split(','))) if args.specific else []
     }
 
-    download_links = client.fetch_episode_links(episodes, ep_range)
-    client.fetch_m3u8_links(download_links, args.resolution, episode_prefix='Episode')
+    # episodes are downloaded in parallel based on max_parallel_downloads
+    scheduler = DownloadScheduler(dl_config_copy) if args.download else None
+
+    def schedule_download(data):
+        # Check if episode already exists in the drama directory
+        existing_episode = os.path.join(drama_dir, f"{data['episodeName']}.mp4")
+        if os.path.exists(existing_episode):
+            print(f"⏩ Skipping existing episode: {data['episodeName']}")
+            return
+
+        # skip episodes for which download link could not be fetched
+        if data.get('error') or not data.get('downloadLink'):
+            print(f"⏩ Skipping episode without download link: {data['episodeName']}")
+            return
+
+        # IMPORTANT: Set both out_dir and file_path correctly
+        # This ensures files end up in the drama directory
+        data['file_path'] = os.path.join(drama_dir, f"{data['episodeName']}.mp4")
+
+        # Make sure the config points to the right drama directory
+        # This is critical for the downloader classes
+        temp_config = dl_config_copy.copy()
+        temp_config['download_dir'] = drama_dir  # Set the download dir to drama directory
+
+        # Schedule download with our custom config
+        scheduler.submit(temp_config, data)
 
     try:
-        if args.download:
-            # When creating downloaders in main():
-            for ep_id, data in client._get_udb_dict().items():
-                # Check if episode already exists in the drama directory
-                existing_episode = os.path.join(drama_dir, f"{data['episodeName']}.mp4")
-                if os.path.exists(existing_episode):
-                    print(f"⏩ Skipping existing episode: {data['episodeName']}")
-                    continue
-    
-                # IMPORTANT: Set both out_dir and file_path correctly
-                # This ensures files end up in the drama directory
-                data['file_path'] = os.path.join(drama_dir, f"{data['episodeName']}.mp4")
-    
-                # Make sure the config points to the right drama directory
-                # This is critical for the downloader classes
-                temp_config = dl_config_copy.copy()
-                temp_config['download_dir'] = drama_dir  # Set the download dir to drama directory
-    
-                # Create downloader with our custom config 
-                if data['downloadType'] == 'hls':
-                    downloader = HLSDownloader(temp_config, data)
-                else:
-                    downloader = BaseDownloader(temp_config, data)
-    
-                # Start download
-                downloader.start_download(data['downloadLink'])
-                
+        if args.resolve_first or not args.download:
+            # resolve links of all the episodes before starting the downloads
+            download_links = client.fetch_episode_links(episodes, ep_range)
+            client.fetch_m3u8_links(download_links, args.resolution, episode_prefix='Episode')
+            if args.download:
+                for ep_id, data in client._get_udb_dict().items():
+                    schedule_download(data)
+        else:
+            # hand over every episode to the scheduler as soon as its link is resolved,
+            # while the links of remaining episodes are resolved alongside the downloads
+            for ep_id, links in client.iter_episode_links(episodes, ep_range):
+                try:
+                    client.fetch_m3u8_links({ep_id: links}, args.resolution, episode_prefix='Episode')
+                    if args.download:
+                        schedule_download(client._get_udb_dict()[ep_id])
+                except Exception as e:
+                    # a failed episode should not stop the remaining episodes
+                    print(f"❌ Failed to schedule episode {ep_id}: {e}")
+
     except KeyboardInterrupt:
+        if scheduler: scheduler.cancel()
+        scheduler = None
         print("\n⛔ Download interrupted by user (CTRL+C).")
     except Exception as e:
         print(f"\n❌ Error during download: {e}")
     finally:
+        # wait for the scheduled downloads to complete, even if resolving the remaining links failed
+        if scheduler:
+            try:
+                failed_downloads = { ep: err for ep, err in scheduler.wait().items() if err }
+                for ep_name, err in failed_downloads.items():
+                    print(f"❌ Failed to download {ep_name}: {err}")
+            except KeyboardInterrupt:
+                print("\n⛔ Download interrupted by user (CTRL+C).")
         print("🙏 Thanks for using Support Bot for UDB!")
 
 if __name__ == '__main__':